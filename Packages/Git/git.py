@@ -5,6 +5,11 @@ import threading
 import subprocess
 import functools
 import tempfile
+import hashlib
+import time
+import json
+import re
+import difflib
 
 # when sublime loads a plugin it's cd'd into the plugin directory. Thus
 # __file__ is useless for my purposes. What I want is "Packages/Git", but
@@ -23,16 +28,178 @@ def open_url(url):
     sublime.active_window().run_command('open_url', {"url": url})
 
 
+# is_enabled gets called for every menu and command palette refresh, so
+# looking up the repository root has to be cheap. Every directory passed
+# through on the way up to a root gets remembered. A remembered root is
+# checked with a single stat of its .git, so a deleted repository is noticed
+# straight away. A new .git is noticed when it's in the directory being
+# looked up, when a file below it is saved, and otherwise once the entry
+# expires.
+class GitRootCache:
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.roots = {}
+        self.lock = threading.Lock()
+
+    def cached(self, directory):
+        with self.lock:
+            entry = self.roots.get(directory)
+        if not entry or entry[1] < time.time():
+            return None
+        root = entry[0]
+        if root and not os.path.exists(os.path.join(root, '.git')):
+            return None
+        if not root and os.path.exists(os.path.join(directory, '.git')):
+            return None
+        return root
+
+    def lookup(self, directory):
+        root = self.cached(directory)
+        if root is not None:
+            return root
+
+        visited = []
+        root = False
+        while directory:
+            if os.path.exists(os.path.join(directory, '.git')):
+                root = directory
+                break
+            visited.append(directory)
+            parent = os.path.realpath(os.path.join(directory, os.path.pardir))
+            if parent == directory:
+                # /.. == /
+                break
+            directory = parent
+            # everything below here has been checked, so the parent's
+            # answer is ours too
+            cached = self.cached(directory)
+            if cached is not None:
+                root = cached
+                break
+
+        expires = time.time() + self.ttl
+        with self.lock:
+            for directory in visited:
+                self.roots[directory] = (root, expires)
+            if root:
+                self.roots[root] = (root, expires)
+        return root
+
+    def invalidate(self, directory=None):
+        with self.lock:
+            if directory is None:
+                self.roots = {}
+            else:
+                for key in self.roots.keys():
+                    if key == directory or key.startswith(
+                            os.path.join(directory, '')):
+                        del self.roots[key]
+
+
+git_root_cache = GitRootCache()
+
+
 def git_root(directory):
-    while directory:
-        if os.path.exists(os.path.join(directory, '.git')):
-            return directory
-        parent = os.path.realpath(os.path.join(directory, os.path.pardir))
-        if parent == directory:
-            # /.. == /
-            return False
-        directory = parent
-    return False
+    return git_root_cache.lookup(directory)
+
+
+def git_command():
+    s = sublime.load_settings("Git.sublime-settings")
+    return s.get('git_command') or 'git'
+
+
+def relative_git_path(root, file_name):
+    # object names like HEAD:path always use forward slashes
+    return os.path.relpath(file_name, root).replace(os.path.sep, '/')
+
+
+def blob_sha(data):
+    # the same hash git gives a file's contents
+    return hashlib.sha1('blob %d\0' % len(data) + data).hexdigest()
+
+
+def split_lines(text):
+    # views always use \n, whatever line endings the file was committed with
+    lines = text.replace('\r\n', '\n').split('\n')
+    # a final newline doesn't start another line as far as git cares
+    if lines and not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def common_ends(a, b):
+    # how many lines a and b share at the start, and then at the end
+    start = 0
+    end = min(len(a), len(b))
+    while start < end and a[start] == b[start]:
+        start += 1
+    suffix = 0
+    while suffix < end - start and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    return start, suffix
+
+
+def line_mapping(old_lines, new_lines):
+    # For each new line, the index of the old line it's unchanged from, or
+    # None if it was added or edited. The common start and end are matched
+    # up directly so difflib only has to look at the part that changed.
+    start, suffix = common_ends(old_lines, new_lines)
+    mapping = range(start) + [None] * (len(new_lines) - start - suffix)
+    matcher = difflib.SequenceMatcher(None,
+        old_lines[start:len(old_lines) - suffix],
+        new_lines[start:len(new_lines) - suffix])
+    for old, new, size in matcher.get_matching_blocks():
+        for i in range(size):
+            mapping[start + new + i] = start + old + i
+    mapping.extend(range(len(old_lines) - suffix, len(old_lines)))
+    return mapping
+
+
+def update_line_mapping(old_lines, prev_lines, prev_mapping, new_lines):
+    # line_mapping(old_lines, new_lines), given the mapping for an earlier
+    # version of new_lines. Lines that haven't changed since then keep
+    # their mapping, and the ones that have are only diffed against the
+    # old lines between their unchanged neighbours.
+    start, suffix = common_ends(prev_lines, new_lines)
+    lo = 0
+    for old in reversed(prev_mapping[:start]):
+        if old is not None:
+            lo = old + 1
+            break
+    hi = len(old_lines)
+    for old in prev_mapping[len(prev_lines) - suffix:]:
+        if old is not None:
+            hi = old
+            break
+
+    middle = line_mapping(old_lines[lo:hi],
+        new_lines[start:len(new_lines) - suffix])
+    return prev_mapping[:start] + \
+        [old if old is None else lo + old for old in middle] + \
+        prev_mapping[len(prev_lines) - suffix:]
+
+
+def diff_hunks(mapping, old_count):
+    # Turns a line mapping into the new lines that were inserted, the ones
+    # that were modified (they replace old lines), and the lines that old
+    # lines were deleted just before.
+    inserted, modified, deleted = [], [], []
+    expected = 0
+    run = []
+    for line, old in enumerate(mapping + [old_count]):
+        if old is None:
+            run.append(line)
+            continue
+        if run:
+            if old > expected:
+                modified.extend(run)
+            else:
+                inserted.extend(run)
+            run = []
+        elif old > expected:
+            deleted.append(min(line, max(0, len(mapping) - 1)))
+        expected = old + 1
+    return inserted, modified, deleted
 
 
 def view_contents(view):
@@ -40,6 +207,13 @@ def view_contents(view):
     return view.substr(region)
 
 
+def view_fallback_encoding(view):
+    # "Western (Windows 1252)" -> "Windows 1252"
+    fallback_encoding = view.settings().get('fallback_encoding')
+    if fallback_encoding:
+        return fallback_encoding.rpartition('(')[2].rpartition(')')[0]
+
+
 def plugin_file(name):
     return os.path.join(PLUGIN_DIRECTORY, name)
 
@@ -57,36 +231,459 @@ def _make_text_safeish(text, fallback_encoding):
 
 
 class CommandThread(threading.Thread):
-    def __init__(self, command, on_done, working_dir="", fallback_encoding=""):
+    # how much output to collect before handing it over to on_output
+    batch_size = 64 * 1024
+    batch_interval = 0.1
+
+    def __init__(self, command, on_done, working_dir="", fallback_encoding="",
+            on_output=None, on_cancel=None):
         threading.Thread.__init__(self)
         self.command = command
-        self.on_done = on_done
+        # identical commands asked for while this one is queued share its
+        # result, or its cancellation
+        self.callbacks = [on_done]
+        self.cancel_callbacks = []
+        if on_cancel:
+            self.cancel_callbacks.append(on_cancel)
         self.working_dir = working_dir
         self.fallback_encoding = fallback_encoding
+        self.on_output = on_output
+        self.proc = None
+        self.queue_key = None
+        # a command either completes or is cancelled, never both
+        self.lock = threading.Lock()
+        self.completed = False
+        self.cancelled = threading.Event()
+        # set whenever the main thread is ready for another batch of output
+        self.ready = threading.Event()
+        self.ready.set()
+
+    def same_as(self, other):
+        # streamed output goes to a view of its own, so those never match
+        return not self.on_output and not other.on_output and \
+            self.command == other.command and \
+            self.working_dir == other.working_dir
+
+    def cancel(self):
+        # returns False if it's too late to cancel
+        with self.lock:
+            if self.completed or self.cancelled.isSet():
+                return False
+            self.cancelled.set()
+        self.ready.set()
+        proc = self.proc
+        if proc and proc.poll() is None:
+            try:
+                proc.terminate()
+            except OSError:
+                # it exited in the meantime
+                pass
+        for callback in self.cancel_callbacks:
+            main_thread(callback)
+        return True
+
+    def on_done(self, result):
+        for callback in self.callbacks:
+            callback(result)
+
+    def done(self, result):
+        # the queue is left before the result is handed over, so the next
+        # command can start straight away
+        self.dequeue()
+        with self.lock:
+            if self.cancelled.isSet():
+                return
+            self.completed = True
+        main_thread(self.on_done, result)
+
+    def dequeue(self):
+        if self.queue_key is not None:
+            key = self.queue_key
+            self.queue_key = None
+            command_queue.finished(key, self)
 
     def run(self):
         try:
             # Per http://bugs.python.org/issue8557 shell=True is required to
             # get $PATH on Windows. Yay portable code.
             shell = os.name == 'nt'
-            if self.working_dir != "":
-                os.chdir(self.working_dir)
-
-            proc = subprocess.Popen(self.command,
+            # cwd rather than os.chdir, which would change it for every
+            # thread at once
+            self.proc = proc = subprocess.Popen(self.command,
                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                shell=shell, universal_newlines=True)
+                shell=shell, universal_newlines=True,
+                cwd=self.working_dir or None)
+            if self.cancelled.isSet():
+                # cancelled before the process was there to stop
+                proc.terminate()
+            if self.on_output:
+                self.stream(proc)
+                self.done(u'')
+                return
             output = proc.communicate()[0]
             # if sublime's python gets bumped to 2.7 we can just do:
             # output = subprocess.check_output(self.command)
-            main_thread(self.on_done,
-                _make_text_safeish(output, self.fallback_encoding))
+            self.done(_make_text_safeish(output, self.fallback_encoding))
         except subprocess.CalledProcessError, e:
-            main_thread(self.on_done, e.returncode)
+            self.done(e.returncode)
         except OSError, e:
             if e.errno == 2:
                 main_thread(sublime.error_message, "Git binary could not be found in PATH\n\nConsider using the git_command setting for the Git plugin\n\nPATH is: %s" % os.environ['PATH'])
             else:
                 raise e
+        finally:
+            self.dequeue()
+
+    def stream(self, proc):
+        # Output gets handed over in batches as it arrives, rather than all
+        # at once when the process exits. Only one batch is ever waiting on
+        # the main thread, so a fast process can't bury the UI in inserts;
+        # the pipe fills up and git just waits for us.
+        batch = []
+        batch_bytes = 0
+        last_flush = time.time()
+        for line in iter(proc.stdout.readline, ''):
+            if self.cancelled.isSet():
+                break
+            batch.append(line)
+            batch_bytes += len(line)
+            if batch_bytes >= self.batch_size or \
+                    time.time() - last_flush >= self.batch_interval:
+                self.flush(batch)
+                batch = []
+                batch_bytes = 0
+                last_flush = time.time()
+        if self.cancelled.isSet():
+            if proc.poll() is None:
+                proc.terminate()
+        elif batch:
+            self.flush(batch)
+        proc.wait()
+
+    def flush(self, batch):
+        self.ready.wait()
+        if self.cancelled.isSet():
+            return
+        self.ready.clear()
+        # batches always end on a line, so a multibyte character can't be
+        # split between two of them
+        main_thread(self.on_output,
+            _make_text_safeish(''.join(batch), self.fallback_encoding),
+            self.ready)
+
+
+# Commands for a repository run one at a time, in the order they were asked
+# for, so they can't trip over each other's index.lock. Asking for a command
+# that's already waiting in the queue for the same directory doesn't run it
+# again; the caller gets the result of the one that's there. A command that
+# is already running may have started before whatever prompted the new
+# request, so that one is left alone.
+class CommandQueue:
+    def __init__(self):
+        # key -> CommandThreads; the first one is running
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, thread):
+        # returns the thread that will do the work, which may be an
+        # identical one that was already queued
+        with self.lock:
+            queue = self.queues.setdefault(key, [])
+            for queued in queue[1:]:
+                if queued.same_as(thread):
+                    queued.callbacks.extend(thread.callbacks)
+                    queued.cancel_callbacks.extend(thread.cancel_callbacks)
+                    return queued
+            thread.queue_key = key
+            queue.append(thread)
+            if len(queue) > 1:
+                return thread
+        thread.start()
+        return thread
+
+    def finished(self, key, thread):
+        with self.lock:
+            queue = self.queues.get(key, [])
+            if thread in queue:
+                queue.remove(thread)
+            if not queue:
+                self.queues.pop(key, None)
+                return
+            next_thread = queue[0]
+        next_thread.start()
+
+    def busy(self, key):
+        with self.lock:
+            return len(self.queues.get(key, [])) > 0
+
+    def cancel(self, key):
+        # stops the running command and drops the rest, letting each of them
+        # know; returns how many commands that was
+        with self.lock:
+            queue = self.queues.get(key, [])
+            threads = list(queue)
+            del queue[1:]
+        return len([thread for thread in threads if thread.cancel()])
+
+
+command_queue = CommandQueue()
+
+
+# `git cat-file --batch` reads object names on stdin and writes the objects
+# out on stdout, so one process can answer any number of lookups. That's a
+# lot cheaper than starting git for every blob or rev-parse, which is slow
+# on Windows and on big repos.
+class CatFileProcess:
+    def __init__(self, git, root):
+        self.git = git
+        self.root = root
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        # shell=True is needed for $PATH on Windows, same as CommandThread
+        self.proc = subprocess.Popen([self.git, 'cat-file', '--batch'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=open(os.devnull, 'w'), cwd=self.root,
+            shell=os.name == 'nt')
+
+    def query(self, name):
+        # returns (sha, type, contents), or None if there's no such object
+        if '\n' in name:
+            return None
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        with self.lock:
+            header = None
+            for attempt in range(2):
+                if not self.proc or self.proc.poll() is not None:
+                    self.start()
+                try:
+                    self.proc.stdin.write(name + '\n')
+                    self.proc.stdin.flush()
+                    header = self.proc.stdout.readline()
+                    break
+                except IOError:
+                    # the process went away; start a new one and try again
+                    self.proc = None
+            # "<name> missing" or "<name> ambiguous" otherwise, where the
+            # name may have spaces in it
+            parts = header and header.rstrip('\n').rsplit(' ', 2)
+            if not parts or len(parts) != 3 or \
+                    not re.match(r'^[0-9a-f]{40}$', parts[0]) or \
+                    not parts[2].isdigit():
+                return None
+            sha, object_type, size = parts
+            contents = self.proc.stdout.read(int(size))
+            self.proc.stdout.read(1)  # trailing newline
+            return (sha, object_type, contents)
+
+    def close(self):
+        with self.lock:
+            if self.proc and self.proc.poll() is None:
+                self.proc.stdin.close()
+                self.proc.wait()
+            self.proc = None
+
+
+class CatFilePool:
+    def __init__(self, max_processes=8):
+        self.max_processes = max_processes
+        self.processes = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def get(self, root, git='git'):
+        key = (root, git)
+        with self.lock:
+            if key in self.order:
+                self.order.remove(key)
+            self.order.append(key)
+            if key not in self.processes:
+                self.processes[key] = CatFileProcess(git, root)
+            # only keep a process around for the most recently used repos
+            while len(self.order) > self.max_processes:
+                self.processes.pop(self.order.pop(0)).close()
+            return self.processes[key]
+
+    def show(self, root, rev, path, git='git'):
+        # contents of path at rev, or None. rev '' means the index
+        result = self.get(root, git).query(rev + ':' + path)
+        if not result or result[1] != 'blob':
+            return None
+        return result[2]
+
+    def rev_parse(self, root, name, git='git'):
+        result = self.get(root, git).query(name)
+        return result and result[0]
+
+    def close_all(self):
+        with self.lock:
+            for process in self.processes.values():
+                process.close()
+            self.processes = {}
+            self.order = []
+
+
+cat_files = CatFilePool()
+
+
+def unload_handler():
+    cat_files.close_all()
+    gutter_diff.stop()
+
+
+# One line of `git status --porcelain`: the index and worktree status codes
+# and the path, plus where it came from for renames and copies.
+class StatusEntry:
+    def __init__(self, index, worktree, path, orig_path=None):
+        self.index = index
+        self.worktree = worktree
+        self.path = path
+        self.orig_path = orig_path
+
+    def untracked(self):
+        return self.index == '?'
+
+    def unmerged(self):
+        return 'U' in (self.index, self.worktree) or \
+            self.index + self.worktree in ('DD', 'AA')
+
+    def staged(self):
+        return self.index not in ' ?!' and not self.unmerged()
+
+    def unstaged(self):
+        return self.worktree not in ' ?!' and not self.unmerged()
+
+    def line(self):
+        # the way `git status --porcelain` shows it
+        path = self.path
+        if self.orig_path:
+            path = self.orig_path + ' -> ' + path
+        return self.index + self.worktree + ' ' + path
+
+
+class GitStatus:
+    change_names = {'M': 'modified', 'A': 'new file', 'D': 'deleted',
+        'R': 'renamed', 'C': 'copied', 'T': 'typechange', 'U': 'unmerged'}
+
+    def __init__(self, branch=None, entries=None):
+        self.branch = branch
+        self.entries = entries or []
+
+    def has_staged_files(self):
+        return len([entry for entry in self.entries if entry.staged()]) > 0
+
+    def describe(self, entries, code):
+        lines = []
+        for entry in entries:
+            path = entry.path
+            if entry.orig_path and code(entry) in 'RC':
+                path = entry.orig_path + ' -> ' + path
+            name = self.change_names.get(code(entry), 'modified') + ':'
+            lines.append('#\t%s %s' % (name.ljust(11), path))
+        return lines
+
+    def commit_template(self):
+        # roughly what `git status` says, commented out
+        lines = []
+        if self.branch:
+            lines.append('# On branch ' + self.branch)
+        sections = [
+            ('Changes to be committed:', self.describe(
+                [entry for entry in self.entries if entry.staged()],
+                lambda entry: entry.index)),
+            ('Unmerged paths:', self.describe(
+                [entry for entry in self.entries if entry.unmerged()],
+                lambda entry: 'U')),
+            ('Changes not staged for commit:', self.describe(
+                [entry for entry in self.entries if entry.unstaged()],
+                lambda entry: entry.worktree)),
+            ('Untracked files:', ['#\t' + entry.path for entry in
+                self.entries if entry.untracked()])
+        ]
+        for title, section in sections:
+            if section:
+                lines.extend(['# ' + title, '#'] + section + ['#'])
+        return '\n'.join(lines)
+
+
+def parse_status(output):
+    # parses `git status --porcelain -b -z`. Paths are NUL terminated and
+    # not quoted, and renames and copies are followed by their source.
+    status = GitStatus()
+    fields = output.split('\0')
+    i = 0
+    while i < len(fields):
+        field = fields[i]
+        i += 1
+        if field.startswith('## '):
+            branch = field[3:].split('...')[0]
+            for prefix in ('No commits yet on ', 'Initial commit on '):
+                if branch.startswith(prefix):
+                    branch = branch[len(prefix):]
+            if branch != 'HEAD (no branch)':
+                status.branch = branch
+            continue
+        if len(field) < 4 or field[2] != ' ':
+            continue
+        entry = StatusEntry(field[0], field[1], field[3:])
+        if entry.index in 'RC' and i < len(fields):
+            entry.orig_path = fields[i]
+            i += 1
+        status.entries.append(entry)
+    return status
+
+
+# Status is slow on big repos and several commands want it, often one right
+# after another, so the parsed result is kept per repository until a file
+# is saved or a git command that could change it is run. Files can also
+# change outside of Sublime, which nothing tells us about, so a status is
+# only reused for a few seconds, and not at all once the index has changed.
+class StatusCache:
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self.statuses = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def index_mtime(self, root):
+        try:
+            return os.path.getmtime(os.path.join(root, '.git', 'index'))
+        except (OSError):
+            return None
+
+    def get(self, root):
+        with self.lock:
+            cached = self.statuses.get(root)
+        if cached and cached[2] > time.time() and \
+                cached[1] == self.index_mtime(root):
+            return cached[0]
+        return None
+
+    def generation(self, root):
+        with self.lock:
+            return self.generations.get(root, 0)
+
+    def put(self, root, generation, status):
+        # a status that was asked for before the last invalidation may
+        # already be out of date, so it isn't kept
+        with self.lock:
+            if self.generations.get(root, 0) == generation:
+                self.statuses[root] = (status, self.index_mtime(root),
+                    time.time() + self.ttl)
+
+    def invalidate(self, root):
+        with self.lock:
+            self.statuses.pop(root, None)
+            self.generations[root] = self.generations.get(root, 0) + 1
+
+
+status_cache = StatusCache()
+
+# git commands that never change what status says
+read_only_commands = set(['status', 'log', 'diff', 'blame', 'show', 'branch',
+    'cat-file', 'rev-parse', 'ls-files', 'ls-remote'])
 
 
 # A base for all commands
@@ -98,7 +695,7 @@ class GitCommand:
         if 'working_dir' not in kwargs:
             kwargs['working_dir'] = self.get_working_dir()
         if 'fallback_encoding' not in kwargs and self.active_view() and self.active_view().settings().get('fallback_encoding'):
-            kwargs['fallback_encoding'] = self.active_view().settings().get('fallback_encoding').rpartition('(')[2].rpartition(')')[0]
+            kwargs['fallback_encoding'] = view_fallback_encoding(self.active_view())
 
         s = sublime.load_settings("Git.sublime-settings")
         if s.get('save_first') and self.active_view() and self.active_view().is_dirty():
@@ -107,13 +704,83 @@ class GitCommand:
             command[0] = s.get('git_command')
         if not callback:
             callback = self.generic_done
+        if len(command) > 1 and command[1] not in read_only_commands:
+            root = git_root(kwargs['working_dir'])
+            if root:
+                status_cache.invalidate(root)
+                callback = functools.partial(self.command_done, root,
+                    callback)
+                kwargs['on_cancel'] = functools.partial(
+                    self.command_cancelled, root, kwargs.get('on_cancel'))
 
         thread = CommandThread(command, callback, **kwargs)
-        thread.start()
+        if kwargs.get('on_output'):
+            # streams last as long as their view is open and don't touch the
+            # index, so they don't wait in (or hold up) the queue
+            thread.start()
+        else:
+            thread = command_queue.add(
+                git_root(kwargs['working_dir']) or kwargs['working_dir'],
+                thread)
 
         if show_status:
             message = kwargs.get('status_message', False) or ' '.join(command)
             sublime.status_message(message)
+        return thread
+
+    def command_done(self, root, callback, result):
+        status_cache.invalidate(root)
+        callback(result)
+
+    def command_cancelled(self, root, on_cancel):
+        # it may have got part way through changing things
+        status_cache.invalidate(root)
+        if on_cancel:
+            on_cancel()
+
+    def get_status(self, callback):
+        # calls callback with the repository's GitStatus, straight away if
+        # it's cached
+        root = git_root(self.get_working_dir())
+        status = status_cache.get(root)
+        if status:
+            callback(status)
+            return
+        self.run_command(['git', 'status', '--porcelain', '-b', '-z'],
+            functools.partial(self.status_loaded, root,
+                status_cache.generation(root), callback),
+            working_dir=root)
+
+    def status_loaded(self, root, generation, callback, result):
+        status = parse_status(result)
+        status_cache.put(root, generation, status)
+        callback(status)
+
+    def stream_command(self, command, title, syntax, callback=None,
+            **kwargs):
+        # Like run_command followed by scratch, except the output shows up
+        # in the scratch view as git writes it. Closing the view stops git.
+        view = self.scratch('', title=title, syntax=syntax)
+        thread = self.run_command(command, functools.partial(
+                self.stream_finished, view, callback or self.stream_done),
+            on_output=functools.partial(self.append_output, view), **kwargs)
+        GitStreamListener.streams[view.id()] = thread
+        return view
+
+    def stream_finished(self, view, callback, result):
+        GitStreamListener.streams.pop(view.id(), None)
+        callback(result)
+
+    def append_output(self, view, output, ready):
+        view.set_read_only(False)
+        edit = view.begin_edit()
+        view.insert(edit, view.size(), output)
+        view.end_edit(edit)
+        view.set_read_only(True)
+        ready.set()
+
+    def stream_done(self, result):
+        sublime.status_message("Git: done")
 
     def generic_done(self, result):
         if not result.strip():
@@ -218,48 +885,298 @@ class GitTextCommand(GitCommand, sublime_plugin.TextCommand):
 
 
 
+# Blame for a committed file only changes when the file does, so it gets
+# cached against the blob the file has at HEAD: in memory for the last few
+# files, and on disk so it survives restarts. Each entry is a table of
+# commits and, per line, an index into that table.
+class BlameCache:
+    # blame is keyed on the repository as well as the path and blob; the
+    # same file can be in several repositories with different histories
+    def __init__(self, max_entries=20, max_files=500):
+        self.max_entries = max_entries
+        self.max_files = max_files
+        self.entries = {}
+        self.order = []
+        self.cache_dir = None
+
+    def filename(self, root, path, blob):
+        if not self.cache_dir:
+            self.cache_dir = os.path.join(sublime.packages_path(), 'User',
+                'Git.cache', 'blame')
+        parts = []
+        for part in (root, path, blob):
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            parts.append(part)
+        key = hashlib.sha1('\0'.join(parts)).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def remember(self, key, blame):
+        if key in self.order:
+            self.order.remove(key)
+        self.order.append(key)
+        self.entries[key] = blame
+        while len(self.order) > self.max_entries:
+            del self.entries[self.order.pop(0)]
+
+    def get(self, root, path, blob):
+        key = (root, path, blob)
+        if key in self.entries:
+            self.remember(key, self.entries[key])
+            return self.entries[key]
+        filename = self.filename(root, path, blob)
+        try:
+            with open(filename) as f:
+                blame = json.load(f)
+            # the oldest files get pruned, so keep this one fresh
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            return None
+        self.remember(key, blame)
+        return blame
+
+    def put(self, root, path, blob, blame):
+        self.remember((root, path, blob), blame)
+        filename = self.filename(root, path, blob)
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # written to the side and moved into place, so a half-written
+            # file never gets read back
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(blame, f)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(filename + '.tmp', filename)
+            self.prune()
+        except (IOError, OSError):
+            pass
+
+    def prune(self):
+        # only the most recently used files are kept on disk
+        names = [name for name in os.listdir(self.cache_dir)
+            if name.endswith('.json')]
+        if len(names) <= self.max_files:
+            return
+        paths = [os.path.join(self.cache_dir, name) for name in names]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_files]:
+            os.remove(path)
+
+
+blame_cache = BlameCache()
+
+
+def parse_blame_porcelain(output):
+    commits = []
+    commit_index = {}
+    lines = []
+    sha = None
+    for line in output.split('\n'):
+        if line.startswith('\t'):
+            lines.append(commit_index[sha])
+            continue
+        parts = line.split(' ')
+        if len(parts[0]) == 40 and len(parts) >= 3:
+            sha = parts[0]
+            if sha not in commit_index:
+                commit_index[sha] = len(commits)
+                commits.append([sha, '', 0, ''])
+        elif sha and parts[0] == 'author':
+            commits[commit_index[sha]][1] = line[7:]
+        elif sha and parts[0] == 'author-time':
+            commits[commit_index[sha]][2] = int(parts[1])
+        elif sha and parts[0] == 'summary':
+            commits[commit_index[sha]][3] = line[8:]
+    return {'commits': commits, 'lines': lines}
+
+
 class GitBlameCommand(GitTextCommand):
     def run(self, edit):
-        # somewhat custom blame command:
-        # -w: ignore whitespace changes
-        # -M: retain blame when moving lines
-        # -C: retain blame when copying lines between files
-        command = ['git', 'blame', '-w', '-M', '-C']
-
         selection = self.view.sel()[0]  # todo: multi-select support?
+        self.line_range = None
         if not selection.empty():
-            # just the lines we have a selection on
+            # just the lines we have a selection on (rows count from 0)
             begin_line, begin_column = self.view.rowcol(selection.begin())
             end_line, end_column = self.view.rowcol(selection.end())
-            lines = str(begin_line) + ',' + str(end_line)
-            command.extend(('-L', lines))
+            self.line_range = (begin_line, end_line)
+
+        # Blame is worked out for the committed file, and carried over to
+        # the current contents of the view. Lines that differ from HEAD
+        # are the only ones that haven't been committed, so they're shown
+        # as such without asking git.
+        root = self.root = git_root(self.get_working_dir())
+        self.path = relative_git_path(root, self.view.file_name())
+        git = git_command()
+        self.blob = cat_files.rev_parse(root, 'HEAD:' + self.path, git)
+        if not self.blob:
+            # not committed yet; let git blame have its say
+            self.run_blame()
+            return
+
+        head = cat_files.show(root, 'HEAD', self.path, git) or ''
+        self.head_lines = split_lines(_make_text_safeish(head,
+            view_fallback_encoding(self.view) or 'utf-8'))
+        self.current_lines = split_lines(view_contents(self.view))
+
+        blame = blame_cache.get(self.root, self.path, self.blob)
+        if blame:
+            self.show_blame(blame)
+            return
+        self.run_command(['git', 'blame', '-w', '-M', '-C', '--porcelain',
+            'HEAD', '--', self.get_file_name()], self.porcelain_done)
 
+    def run_blame(self):
+        # somewhat custom blame command:
+        # -w: ignore whitespace changes
+        # -M: retain blame when moving lines
+        # -C: retain blame when copying lines between files
+        command = ['git', 'blame', '-w', '-M', '-C']
+        if self.line_range:
+            command.extend(('-L', '%d,%d' % (self.line_range[0] + 1,
+                self.line_range[1] + 1)))
         command.append(self.get_file_name())
         self.run_command(command, self.blame_done)
 
+    def porcelain_done(self, result):
+        blame = parse_blame_porcelain(result)
+        if not blame['lines']:
+            # something went wrong; show whatever git had to say about it
+            self.blame_done(result)
+            return
+        blame_cache.put(self.root, self.path, self.blob, blame)
+        self.show_blame(blame)
+
+    def show_blame(self, blame):
+        mapping = line_mapping(self.head_lines, self.current_lines)
+        begin, end = 0, len(self.current_lines)
+        if self.line_range:
+            begin = self.line_range[0]
+            end = min(end, self.line_range[1] + 1)
+
+        not_committed = ['0' * 40, 'Not Committed Yet', int(time.time()), '']
+        rows = []
+        for line in range(begin, end):
+            head_line = mapping[line]
+            if head_line is None or head_line >= len(blame['lines']):
+                commit = not_committed
+            else:
+                commit = blame['commits'][blame['lines'][head_line]]
+            rows.append((commit, line))
+
+        author_width = max([len(commit[1]) for commit, line in rows] + [0])
+        number_width = len(str(end))
+        output = []
+        for commit, line in rows:
+            date = time.strftime('%Y-%m-%d %H:%M:%S',
+                time.localtime(commit[2]))
+            output.append(u'%s (%s %s %s) %s' % (commit[0][:8],
+                commit[1].ljust(author_width), date,
+                str(line + 1).rjust(number_width), self.current_lines[line]))
+        self.blame_done(u'\n'.join(output) + u'\n')
+
     def blame_done(self, result):
         self.scratch(result, title="Git Blame")
 
 
+# The log is loaded a page at a time: the first page gets shown as soon as
+# it's ready, and the next one is fetched in the background while the user
+# looks at it, so "More commits..." is usually instant. Commits are kept as
+# the raw log lines and only split up when the panel is shown. Searching
+# hands the work to `git log --grep`, which pages the same way, so old
+# commits can be found without loading the whole history.
 class GitLog:
+    page_size = 500
+    generation = 0
+
     def run(self, edit=None):
+        self.start_log()
+
+    def start_log(self, grep=None):
+        # bumping the generation means pages still loading for an earlier
+        # log/search get ignored when they show up
+        self.generation += 1
+        self.grep = grep
+        self.commits = []
+        self.complete = False
+        self.loading = False
+        self.show_when_loaded = True
+        self.load_page(show_status=True)
+
+    def log_command(self, skip):
         # the ASCII bell (\a) is just a convenient character I'm pretty sure
         # won't ever come up in the subject of the commit (and if it does then
         # you positively deserve broken output...)
-        # 9000 is a pretty arbitrarily chosen limit; picked entirely because
-        # it's about the size of the largest repo I've tested this on... and
-        # there's a definite hiccup when it's loading that
-        self.run_command(
-            ['git', 'log', '--pretty=%s\a%h %an <%aE>\a%ad (%ar)',
-            '--date=local', '--max-count=9000', '--', self.get_file_name()],
-            self.log_done)
-
-    def log_done(self, result):
-        self.results = [r.split('\a', 2) for r in result.strip().split('\n')]
-        self.quick_panel(self.results, self.panel_done)
+        command = ['git', 'log', '--pretty=%s\a%h %an <%aE>\a%ad (%ar)',
+            '--date=local', '--max-count=%d' % self.page_size,
+            '--skip=%d' % skip]
+        if self.grep:
+            command.extend(['--regexp-ignore-case', '--grep=' + self.grep])
+        command.extend(['--', self.get_file_name()])
+        return command
+
+    def load_page(self, show_status=False):
+        self.loading = True
+        self.run_command(self.log_command(len(self.commits)),
+            functools.partial(self.page_done, self.generation),
+            show_status=show_status)
+
+    def page_done(self, generation, result):
+        if generation != self.generation:
+            return
+        self.loading = False
+        commits = [line for line in result.strip().split('\n') if line]
+        self.commits.extend(commits)
+        self.complete = len(commits) < self.page_size
+        if self.show_when_loaded:
+            self.show_when_loaded = False
+            self.log_done()
+
+    def log_done(self):
+        if not self.commits:
+            sublime.status_message("No matching commits" if self.grep
+                else "No commits")
+            return
+        self.results = [commit.split('\a', 2) for commit in self.commits]
+        # every quick panel item has to have the same number of lines
+        self.actions = []
+        if not self.complete:
+            self.actions.append(('more', ["More commits...",
+                "%d commits loaded" % len(self.commits), ""]))
+        self.actions.append(('search', ["Search commit messages...",
+            "Searching for \"%s\"" % self.grep if self.grep else
+            "Finds older commits too", ""]))
+        if self.grep:
+            self.actions.append(('all', ["Show all commits", "", ""]))
+        self.quick_panel(self.results +
+            [item for action, item in self.actions], self.panel_done)
+        # get the next page ready in case it's asked for
+        if not self.complete and not self.loading:
+            self.load_page()
+
+    def action_picked(self, action):
+        if action == 'more':
+            if len(self.commits) > len(self.results):
+                self.log_done()
+            else:
+                self.show_when_loaded = True
+                if not self.loading:
+                    self.load_page()
+                sublime.status_message("Loading more commits...")
+        elif action == 'search':
+            self.get_window().show_input_panel("Search commit messages",
+                self.grep or "", self.search_input, None, None)
+        elif action == 'all':
+            self.start_log()
+
+    def search_input(self, grep):
+        self.start_log(grep.strip() or None)
 
     def panel_done(self, picked):
-        if 0 > picked < len(self.results):
+        if picked < 0:
+            return
+        if picked >= len(self.results):
+            self.action_picked(self.actions[picked - len(self.results)][0])
             return
         item = self.results[picked]
         # the commit hash is the first thing on the second line
@@ -283,15 +1200,12 @@ class GitLogAllCommand(GitLog, GitWindowCommand):
 
 class GitGraph:
     def run(self, edit=None):
-        self.run_command(
+        self.stream_command(
             ['git', 'log', '--graph', '--pretty=%h %aN %ci%d %s', '--abbrev-commit', '--no-color', '--decorate',
             '--date-order', '--', self.get_file_name()],
-            self.log_done
+            title="Git Log Graph", syntax=plugin_file("Git Graph.tmLanguage")
         )
 
-    def log_done(self, result):
-        self.scratch(result, title="Git Log Graph", syntax=plugin_file("Git Graph.tmLanguage"))
-
 
 class GitGraphCommand(GitGraph, GitTextCommand):
     pass
@@ -302,9 +1216,31 @@ class GitGraphAllCommand(GitGraph, GitWindowCommand):
 
 class GitDiff:
     def run(self, edit=None):
+        if self.file_unchanged():
+            self.panel("No output")
+            return
         self.run_command(['git', 'diff', '--no-color', self.get_file_name()],
             self.diff_done)
 
+    def file_unchanged(self):
+        # git diff compares the file to the index, so if the file hashes to
+        # the same blob as its index entry there's nothing to show, and we
+        # can say so without waiting on a git process. Anything else (which
+        # includes files that only differ by line endings or filters) goes
+        # to git diff as usual.
+        if not self.get_file_name() or self.active_view().is_dirty():
+            return False
+        file_name = os.path.join(self.get_working_dir(), self.get_file_name())
+        root = git_root(self.get_working_dir())
+        try:
+            with open(file_name, 'rb') as f:
+                data = f.read()
+            index_sha = cat_files.rev_parse(root,
+                ':' + relative_git_path(root, file_name), git_command())
+        except (IOError, OSError):
+            return False
+        return index_sha == blob_sha(data)
+
     def diff_done(self, result):
         if not result.strip():
             self.panel("No output")
@@ -318,6 +1254,173 @@ class GitDiffAllCommand(GitDiff, GitWindowCommand):
     pass
 
 
+# Marks the lines of a view that differ from HEAD in the gutter. The HEAD
+# version of the file comes from the cat-file process, and the diff is done
+# here rather than by git, on a single worker thread, so typing doesn't
+# start any processes or threads. Edits are
+# diffed a while after the typing stops, and only the lines that changed
+# since the last diff are looked at again; saving or switching back to the
+# view does a full diff, which also picks up new commits.
+class GutterDiff:
+    def __init__(self):
+        # view id -> what the last diff was worked out from
+        self.states = {}
+        self.generations = {}
+        # view id -> the latest diff asked for, waiting for the worker.
+        # Asking again replaces it, so a busy repo can't build up a backlog.
+        self.requests = {}
+        self.order = []
+        self.condition = threading.Condition()
+        self.worker = None
+        self.stopped = False
+
+    def update(self, view, full=False):
+        file_name = view.file_name()
+        root = file_name and git_root(os.path.dirname(file_name))
+        if not root:
+            return
+        view_id = view.id()
+        # the view and settings can only be read from the main thread, but
+        # the rest can happen in the background
+        lines = split_lines(view_contents(view))
+        git = git_command()
+        with self.condition:
+            generation = self.generations.get(view_id, 0) + 1
+            self.generations[view_id] = generation
+            previous = self.requests.get(view_id)
+            if previous:
+                # a full diff that hasn't happened yet still needs to
+                full = full or previous[-1]
+            else:
+                self.order.append(view_id)
+            self.requests[view_id] = (view, view_id, generation, root, git,
+                relative_git_path(root, file_name), lines,
+                view_fallback_encoding(view) or 'utf-8', full)
+            if not self.worker:
+                self.worker = threading.Thread(target=self.work)
+                self.worker.setDaemon(True)
+                self.worker.start()
+            self.condition.notify()
+
+    def work(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.order and not self.stopped:
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+                    request = self.requests.pop(self.order.pop(0))
+                try:
+                    self.diff(*request)
+                except (OSError, IOError):
+                    # git couldn't be run; there's just nothing to show
+                    self.clear(*request[:3])
+        finally:
+            # anything unexpected goes to the console like any other error,
+            # and the next update starts a new worker
+            with self.condition:
+                self.worker = None
+
+    def diff(self, view, view_id, generation, root, git, path, lines,
+            fallback_encoding, full):
+        # states are only changed here, on the worker, apart from being
+        # forgotten when their view closes
+        state = self.states.get(view_id)
+        if full or not state:
+            head = cat_files.get(root, git).query('HEAD:' + path)
+            if not head or head[1] != 'blob':
+                self.clear(view, view_id, generation)
+                return
+            if not state or state['blob'] != head[0]:
+                state = {'blob': head[0], 'head_lines': split_lines(
+                    _make_text_safeish(head[2], fallback_encoding))}
+            state['mapping'] = line_mapping(state['head_lines'], lines)
+        else:
+            state['mapping'] = update_line_mapping(state['head_lines'],
+                state['lines'], state['mapping'], lines)
+        state['lines'] = lines
+        with self.condition:
+            if view_id in self.generations:
+                self.states[view_id] = state
+        hunks = diff_hunks(state['mapping'], len(state['head_lines']))
+        main_thread(self.draw, view, generation, *hunks)
+
+    def clear(self, view, view_id, generation):
+        with self.condition:
+            self.states.pop(view_id, None)
+        main_thread(self.draw, view, generation, [], [], [])
+
+    def draw(self, view, generation, inserted, modified, deleted):
+        if self.generations.get(view.id()) != generation:
+            # there's a newer diff on the way
+            return
+        for name, lines, scope, icon in (
+                ('inserted', inserted, 'markup.inserted', 'dot'),
+                ('modified', modified, 'markup.changed', 'dot'),
+                ('deleted', deleted, 'markup.deleted', 'bookmark')):
+            regions = [view.line(view.text_point(line, 0)) for line in lines]
+            view.add_regions('git_gutter_' + name, regions, scope, icon,
+                sublime.HIDDEN | sublime.DRAW_EMPTY)
+
+    def forget(self, view):
+        view_id = view.id()
+        with self.condition:
+            self.states.pop(view_id, None)
+            self.generations.pop(view_id, None)
+            if self.requests.pop(view_id, None):
+                self.order.remove(view_id)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notifyAll()
+
+
+gutter_diff = GutterDiff()
+
+
+class GitGutterListener(sublime_plugin.EventListener):
+    # view id -> the latest modification, so only the last of a burst of
+    # them gets diffed
+    pending = {}
+
+    def enabled(self):
+        s = sublime.load_settings("Git.sublime-settings")
+        return s.get('gutter_diff')
+
+    def on_load(self, view):
+        if self.enabled():
+            gutter_diff.update(view, full=True)
+
+    def on_activated(self, view):
+        if self.enabled():
+            gutter_diff.update(view, full=True)
+
+    def on_post_save(self, view):
+        if self.enabled():
+            gutter_diff.update(view, full=True)
+
+    def on_modified(self, view):
+        if not self.enabled():
+            return
+        s = sublime.load_settings("Git.sublime-settings")
+        count = self.pending.get(view.id(), 0) + 1
+        self.pending[view.id()] = count
+        sublime.set_timeout(functools.partial(self.modified_done, view,
+            count), s.get('gutter_diff_delay', 500))
+
+    def modified_done(self, view, count):
+        if self.pending.get(view.id()) != count:
+            return
+        del self.pending[view.id()]
+        gutter_diff.update(view)
+
+    def on_close(self, view):
+        self.pending.pop(view.id(), None)
+        gutter_diff.forget(view)
+
+
 class GitQuickCommitCommand(GitTextCommand):
     def run(self, edit):
         self.get_window().show_input_panel("Message", "",
@@ -344,9 +1447,9 @@ class GitQuickCommitCommand(GitTextCommand):
 # -w to sublime, which means the editor won't wait, and so the commit will fail
 # with an empty message.
 # Thus this flow:
-# 1. `status --porcelain --untracked-files=no` to know whether files need
+# 1. Get the repository's status (usually cached) to know whether files need
 #    to be committed
-# 2. `status` to get a template commit message (not the exact one git uses; I
+# 2. Make a template commit message from it (not the exact one git uses; I
 #    can't see a way to ask it to output that, which is not quite ideal)
 # 3. Create a scratch buffer containing the template
 # 4. When this buffer is closed, get its contents with an event handler and
@@ -360,32 +1463,18 @@ class GitCommitCommand(GitWindowCommand):
     active_message = False
 
     def run(self):
-        self.run_command(
-            ['git', 'status', '--untracked-files=no', '--porcelain'],
-            self.porcelain_status_done
-            )
-
-    def porcelain_status_done(self, result):
-        # todo: split out these status-parsing things...
-        has_staged_files = False
-        result_lines = result.rstrip().split('\n')
-        for line in result_lines:
-            if not line[0].isspace():
-                has_staged_files = True
-                break
-        if not has_staged_files:
+        self.get_status(self.status_done)
+
+    def status_done(self, status):
+        if not status.has_staged_files():
             self.panel("Nothing to commit")
             return
-        # Okay, get the template!
-        self.run_command(['git', 'status'], self.status_done)
-
-    def status_done(self, result):
         template = "\n".join([
             "",
             "# Please enter the commit message for your changes. Lines starting",
             "# with '#' will be ignored, and an empty message aborts the commit.",
             "# Just close the window to accept your message.",
-            result.strip()
+            status.commit_template()
         ])
         msg = self.window.new_file()
         msg.set_scratch(True)
@@ -407,12 +1496,26 @@ class GitCommitCommand(GitWindowCommand):
         self.message_file = message_file
         # and actually commit
         self.run_command(['git', 'commit', '-F', message_file.name],
-            self.commit_done)
+            self.commit_done, on_cancel=self.commit_cancelled)
 
     def commit_done(self, result):
         os.remove(self.message_file.name)
         self.panel(result)
 
+    def commit_cancelled(self):
+        os.remove(self.message_file.name)
+        sublime.status_message("Git: commit cancelled")
+
+
+class GitStreamListener(sublime_plugin.EventListener):
+    # view id -> the CommandThread streaming into it
+    streams = {}
+
+    def on_close(self, view):
+        thread = self.streams.pop(view.id(), None)
+        if thread:
+            thread.cancel()
+
 
 class GitCommitMessageListener(sublime_plugin.EventListener):
     def on_close(self, view):
@@ -425,36 +1528,47 @@ class GitCommitMessageListener(sublime_plugin.EventListener):
         command.message_done(message)
 
 
+class GitStatusListener(sublime_plugin.EventListener):
+    def on_post_save(self, view):
+        if not view.file_name():
+            return
+        # a repository may have been created or removed since the file's
+        # directory was last looked up
+        directory = os.path.dirname(view.file_name())
+        git_root_cache.invalidate(directory)
+        root = git_root(directory)
+        if root:
+            status_cache.invalidate(root)
+
+
 class GitStatusCommand(GitWindowCommand):
     def run(self):
-        self.run_command(['git', 'status', '--porcelain'], self.status_done)
+        self.get_status(self.status_done)
 
-    def status_done(self, result):
-        self.results = filter(self.status_filter, result.rstrip().split('\n'))
+    def status_done(self, status):
+        self.results = filter(self.status_filter, status.entries)
         if len(self.results):
             self.show_status_list()
         else:
             sublime.status_message("Nothing to show")
 
     def show_status_list(self):
-        self.quick_panel(self.results, self.panel_done,
-            sublime.MONOSPACE_FONT)
+        self.quick_panel([entry.line() for entry in self.results],
+            self.panel_done, sublime.MONOSPACE_FONT)
 
-    def status_filter(self, item):
+    def status_filter(self, entry):
         # for this class we don't actually care
-        return len(item) > 0
+        return True
 
     def panel_done(self, picked):
         if 0 > picked < len(self.results):
             return
-        picked_file = self.results[picked]
-        # first 3 characters are status codes
-        picked_file = picked_file[3:]
-        self.panel_followup(picked_file, picked)
+        entry = self.results[picked]
+        self.panel_followup(entry and entry.path, picked)
 
     def panel_followup(self, picked_file, picked_index):
         # split out solely so I can override it for laughs
-        self.run_command(['git', 'diff', '--no-color', '--', picked_file.strip('"')],
+        self.run_command(['git', 'diff', '--no-color', '--', picked_file],
             self.diff_done, working_dir=git_root(self.get_working_dir()))
 
     def diff_done(self, result):
@@ -464,18 +1578,19 @@ class GitStatusCommand(GitWindowCommand):
 
 
 class GitAddChoiceCommand(GitStatusCommand):
-    def status_filter(self, item):
-        return not item[1].isspace()
+    def status_filter(self, entry):
+        return entry.worktree != ' '
 
     def show_status_list(self):
-        self.results.insert(0, [" + All Files", "apart from untracked files"])
-        self.quick_panel(self.results, self.panel_done,
-            sublime.MONOSPACE_FONT)
+        items = [entry.line() for entry in self.results]
+        self.results.insert(0, None)
+        items.insert(0, [" + All Files", "apart from untracked files"])
+        self.quick_panel(items, self.panel_done, sublime.MONOSPACE_FONT)
 
     def panel_followup(self, picked_file, picked_index):
         if picked_index == 0:
             picked_file = '.'
-        self.run_command(['git', 'add', "--", picked_file.strip('"')],
+        self.run_command(['git', 'add', "--", picked_file],
             working_dir=git_root(self.get_working_dir()))
 
 
@@ -521,6 +1636,17 @@ class GitCheckoutCommand(GitTextCommand):
         self.view.run_command('revert')
 
 
+class GitCancelCommand(GitWindowCommand):
+    def is_enabled(self):
+        root = GitWindowCommand.is_enabled(self)
+        return root and command_queue.busy(root)
+
+    def run(self):
+        count = command_queue.cancel(git_root(self.get_working_dir()))
+        sublime.status_message("Git: cancelled %d command%s" % (count,
+            count != 1 and 's' or ''))
+
+
 class GitPullCommand(GitWindowCommand):
     def run(self):
         self.run_command(['git', 'pull'])
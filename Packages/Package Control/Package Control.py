@@ -6,6 +6,8 @@ import sys
 import subprocess
 import zipfile
 import urllib2
+import httplib
+import socket
 import json
 import fnmatch
 import re
@@ -15,6 +17,13 @@ import time
 import shutil
 import _strptime
 import tempfile
+import hashlib
+import zlib
+import struct
+import functools
+import traceback
+import random
+import Queue
 
 try:
     import ssl
@@ -95,23 +104,110 @@ class ThreadProgress():
         sublime.set_timeout(lambda: self.run(i), 100)
 
 
+class Span():
+    def __init__(self, tracer, kind, name, attrs):
+        self.tracer = tracer
+        self.kind = kind
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.finished = False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, **attrs):
+        if self.finished:
+            return
+        self.finished = True
+        self.attrs.update(attrs)
+        self.tracer.record(self.kind, self.name, time.time() - self.start,
+            self.start, **self.attrs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type:
+            self.attrs['error'] = type.__name__
+        self.finish()
+
+
+class Tracer():
+    # Records how long downloads, connections, JSON parsing, package
+    # extraction and VCS commands take, along with bytes transferred and
+    # cache hits. The most recent spans are kept for the performance report
+    # and can be exported to a JSON lines file.
+    def __init__(self, max_spans=2000):
+        self.max_spans = max_spans
+        self.lock = threading.Lock()
+        self.spans = []
+        self.trace_file = None
+
+    def set_trace_file(self, trace_file):
+        with self.lock:
+            self.trace_file = trace_file or None
+
+    def span(self, kind, name, **attrs):
+        return Span(self, kind, name, attrs)
+
+    def record(self, kind, name, duration=0, start=None, **attrs):
+        span = {
+            'kind': kind,
+            'name': name,
+            'start': start or time.time(),
+            'duration': duration,
+            'thread': threading.currentThread().getName()
+        }
+        span.update(attrs)
+        with self.lock:
+            self.spans.append(span)
+            if len(self.spans) > self.max_spans:
+                self.spans = self.spans[-self.max_spans:]
+
+    def get_spans(self):
+        with self.lock:
+            return list(self.spans)
+
+    def export(self, path=None):
+        # Writes the kept spans to path, or the trace_file setting
+        path = path or self.trace_file
+        if not path:
+            return
+        try:
+            with open(path, 'w') as f:
+                for span in self.get_spans():
+                    f.write(json.dumps(span) + '\n')
+        except (IOError) as (exception):
+            print '%s: Unable to write to trace file %s. %s' % (
+                __name__, path, str(exception))
+
+
+_tracer = Tracer()
+
+
 class ChannelProvider():
-    def __init__(self, channel, package_manager):
+    def __init__(self, channel, package_manager, validators=None):
         self.channel_info = None
         self.channel = channel
         self.package_manager = package_manager
+        self.validators = validators
 
     def match_url(self, url):
         return True
 
     def fetch_channel(self):
         channel_json = self.package_manager.download_url(self.channel,
-            'Error downloading channel.')
+            'Error downloading channel.', self.validators)
         if channel_json == False:
             self.channel_info = False
             return
+        if channel_json == NOT_MODIFIED:
+            self.channel_info = NOT_MODIFIED
+            return
         try:
-            channel_info = json.loads(channel_json)
+            with _tracer.span('parse', self.channel, bytes=len(channel_json)):
+                channel_info = json.loads(channel_json)
         except (ValueError):
             sublime.error_message(__name__ + ': Error parsing JSON from ' +
                 ' channel ' + self.channel + '.')
@@ -124,6 +220,8 @@ class ChannelProvider():
             self.fetch_channel()
         if self.channel_info == False:
             return False
+        if self.channel_info == NOT_MODIFIED:
+            return NOT_MODIFIED
         return self.channel_info['package_name_map']
 
     def get_repositories(self):
@@ -131,6 +229,8 @@ class ChannelProvider():
             self.fetch_channel()
         if self.channel_info == False:
             return False
+        if self.channel_info == NOT_MODIFIED:
+            return NOT_MODIFIED
         return self.channel_info['repositories']
 
 
@@ -141,13 +241,16 @@ class PackageProvider():
     def match_url(self, url):
         return True
 
-    def get_packages(self, repo, package_manager):
+    def get_packages(self, repo, package_manager, validators=None):
         repository_json = package_manager.download_url(repo,
-            'Error downloading repository.')
+            'Error downloading repository.', validators)
         if repository_json == False:
             return False
+        if repository_json == NOT_MODIFIED:
+            return NOT_MODIFIED
         try:
-            repo_info = json.loads(repository_json)
+            with _tracer.span('parse', repo, bytes=len(repository_json)):
+                repo_info = json.loads(repository_json)
         except (ValueError):
             sublime.error_message(__name__ + ': Error parsing JSON from ' +
                 ' repository ' + repo + '.')
@@ -182,16 +285,19 @@ class GitHubPackageProvider():
     def match_url(self, url):
         return re.search('^https?://github.com/[^/]+/[^/]+/?$', url) != None
 
-    def get_packages(self, repo, package_manager):
+    def get_packages(self, repo, package_manager, validators=None):
         api_url = re.sub('^https?://github.com/',
             'https://api.github.com/repos/', repo)
         api_url = api_url.rstrip('/')
         repo_json = package_manager.download_url(api_url,
-            'Error downloading repository.')
+            'Error downloading repository.', validators)
         if repo_json == False:
             return False
+        if repo_json == NOT_MODIFIED:
+            return NOT_MODIFIED
         try:
-            repo_info = json.loads(repo_json)
+            with _tracer.span('parse', api_url, bytes=len(repo_json)):
+                repo_info = json.loads(repo_json)
         except (ValueError):
             sublime.error_message(__name__ + ': Error parsing JSON from ' +
                 ' repository ' + api_url + '.')
@@ -227,16 +333,19 @@ class GitHubUserProvider():
     def match_url(self, url):
         return re.search('^https?://github.com/[^/]+/?$', url) != None
 
-    def get_packages(self, url, package_manager):
+    def get_packages(self, url, package_manager, validators=None):
         api_url = re.sub('^https?://github.com/',
             'https://api.github.com/users/', url)
         api_url = api_url.rstrip('/') + '/repos'
         repo_json = package_manager.download_url(api_url,
-            'Error downloading repository.')
+            'Error downloading repository.', validators)
         if repo_json == False:
             return False
+        if repo_json == NOT_MODIFIED:
+            return NOT_MODIFIED
         try:
-            repo_info = json.loads(repo_json)
+            with _tracer.span('parse', api_url, bytes=len(repo_json)):
+                repo_info = json.loads(repo_json)
         except (ValueError):
             sublime.error_message(__name__ + ': Error parsing JSON from ' +
                 ' repository ' + api_url + '.')
@@ -275,32 +384,40 @@ class BitBucketPackageProvider():
     def match_url(self, url):
         return re.search('^https?://bitbucket.org', url) != None
 
-    def get_packages(self, repo, package_manager):
+    def get_packages(self, repo, package_manager, validators=None):
         api_url = re.sub('^https?://bitbucket.org/',
             'https://api.bitbucket.org/1.0/repositories/', repo)
         api_url = api_url.rstrip('/')
-        repo_json = package_manager.download_url(api_url,
-            'Error downloading repository.')
-        if repo_json == False:
+
+        # The latest changeset is checked first since if it has not changed
+        # there is no need to download the repository info at all
+        changeset_url = api_url + '/changesets/default'
+        changeset_json = package_manager.download_url(changeset_url,
+            'Error downloading repository.', validators)
+        if changeset_json == False:
             return False
+        if changeset_json == NOT_MODIFIED:
+            return NOT_MODIFIED
         try:
-            repo_info = json.loads(repo_json)
+            with _tracer.span('parse', changeset_url, bytes=len(changeset_json)):
+                last_commit = json.loads(changeset_json)
         except (ValueError):
             sublime.error_message(__name__ + ': Error parsing JSON from ' +
-                ' repository ' + api_url + '.')
+                ' repository ' + changeset_url + '.')
             return False
 
-        changeset_url = api_url + '/changesets/default'
-        changeset_json = package_manager.download_url(changeset_url,
+        repo_json = package_manager.download_url(api_url,
             'Error downloading repository.')
-        if changeset_json == False:
+        if repo_json == False:
             return False
         try:
-            last_commit = json.loads(changeset_json)
+            with _tracer.span('parse', api_url, bytes=len(repo_json)):
+                repo_info = json.loads(repo_json)
         except (ValueError):
             sublime.error_message(__name__ + ': Error parsing JSON from ' +
-                ' repository ' + changeset_url + '.')
+                ' repository ' + api_url + '.')
             return False
+
         commit_date = last_commit['timestamp']
         timestamp = datetime.datetime.strptime(commit_date[0:19],
             '%Y-%m-%d %H:%M:%S')
@@ -330,6 +447,56 @@ _package_providers = [BitBucketPackageProvider, GitHubPackageProvider,
     GitHubUserProvider, PackageProvider]
 
 
+class NotModified():
+    pass
+
+
+# Returned by downloaders, and passed on by providers, when a conditional
+# request found the content to be unchanged since it was last downloaded
+NOT_MODIFIED = NotModified()
+
+
+def conditional_headers(validators):
+    headers = {}
+    if not validators:
+        return headers
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def hash_file(path, hash=None):
+    if hash == None:
+        hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            hash.update(chunk)
+    return hash
+
+
+def partial_size(dest_path):
+    if dest_path and os.path.exists(dest_path):
+        return os.path.getsize(dest_path)
+    return 0
+
+
+# The most times a download that keeps dropping is resumed without the
+# try counting, so that a connection that drops every few KB still fails
+MAX_RESUMES = 10
+
+
+def resume_credit(dest_path, resume_from, resumes):
+    # 1 if the try that just failed received data and should be given back
+    if partial_size(dest_path) > resume_from and resumes < MAX_RESUMES:
+        return 1
+    return 0
+
+
 class BinaryNotFoundError(Exception):
     pass
 
@@ -369,13 +536,193 @@ class CliDownloader():
             raise error
         return output
 
+    def parse_validators(self, header_lines):
+        validators = {}
+        for line in header_lines:
+            line = line.strip()
+            # Each redirect has its own set of headers, and only the ones
+            # from the final response apply to the content
+            if re.match('^HTTP/\d', line):
+                validators = {}
+                continue
+            match = re.match('^(ETag|Last-Modified):\s*(.*)$', line, re.I)
+            if match:
+                key = match.group(1).lower().replace('-', '_')
+                validators[key] = match.group(2)
+        return validators
+
+
+class PooledHTTPResponse(httplib.HTTPResponse):
+    on_close = None
+    reading = False
+
+    def read(self, amt=None):
+        # httplib closes the response as soon as the body has been fully
+        # read, at which point the connection can be used for a new request
+        self.reading = True
+        try:
+            data = httplib.HTTPResponse.read(self, amt)
+        except:
+            self.reading = False
+            self.release(False)
+            raise
+        self.reading = False
+        if self.fp is None:
+            self.release(self.complete())
+        return data
+
+    def complete(self):
+        # A chunked body that ends early raises IncompleteRead instead
+        return self.length == 0 or (self.chunked and self.length is None)
+
+    def close(self):
+        # A response closed before its body was read, such as the fp of an
+        # HTTPError, leaves unread bytes on the connection
+        complete = self.length == 0
+        httplib.HTTPResponse.close(self)
+        if not self.reading:
+            self.release(complete)
+
+    def release(self, complete):
+        if self.on_close:
+            on_close = self.on_close
+            self.on_close = None
+            on_close(complete and not self.will_close)
+
+
+class ConnectionPool():
+    # Idle keep-alive connections are kept per scheme and host so that
+    # repeated API calls to GitHub and BitBucket do not each pay for a new
+    # TCP connection and TLS handshake
+    def __init__(self, max_idle_time=30):
+        self.max_idle_time = max_idle_time
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def get(self, scheme, host, timeout):
+        key = (scheme, host)
+        with self.lock:
+            idle = self.connections.get(key, [])
+            while idle:
+                connection, last_used = idle.pop()
+                if time.time() - last_used > self.max_idle_time:
+                    connection.close()
+                    continue
+                connection.timeout = timeout
+                if connection.sock:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, timeout=timeout)
+        else:
+            connection = httplib.HTTPConnection(host, timeout=timeout)
+        connection.response_class = PooledHTTPResponse
+        return connection, False
+
+    def put(self, scheme, host, connection):
+        now = time.time()
+        with self.lock:
+            for key in self.connections.keys():
+                for idle in self.connections[key][:]:
+                    if now - idle[1] > self.max_idle_time:
+                        idle[0].close()
+                        self.connections[key].remove(idle)
+            self.connections.setdefault((scheme, host), []).append(
+                (connection, now))
+
+    def release(self, scheme, host, connection, reusable):
+        if reusable:
+            self.put(scheme, host, connection)
+        else:
+            connection.close()
+
+    def close_all(self):
+        with self.lock:
+            for idle in self.connections.values():
+                for connection, last_used in idle:
+                    connection.close()
+            self.connections = {}
+
+
+_connection_pool = ConnectionPool()
+
+
+class KeepAliveHandler(urllib2.BaseHandler):
+    # Run before the default HTTP and HTTPS handlers, which always close the
+    # connection after a single request
+    handler_order = 400
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.do_open('http', req)
+
+    def https_open(self, req):
+        if not hasattr(httplib, 'HTTPS'):
+            return None
+        return self.do_open('https', req)
+
+    def do_open(self, scheme, req):
+        # Tunneling through a proxy is left to the default handlers
+        if getattr(req, '_tunnel_host', None):
+            return None
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        while True:
+            connection, reused = self.pool.get(scheme, host, req.timeout)
+            try:
+                # Connecting explicitly separates the time spent on DNS, TCP
+                # and TLS from the time spent waiting on the server
+                if not reused:
+                    with _tracer.span('connect', scheme + '://' + host):
+                        connection.connect()
+                with _tracer.span('response', req.get_full_url(),
+                        reused=reused):
+                    connection.request(req.get_method(), req.get_selector(),
+                        req.data, headers)
+                    response = connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error) as (e):
+                connection.close()
+                # The server may have closed an idle connection, in which
+                # case the request is retried on another connection
+                if reused:
+                    continue
+                raise urllib2.URLError(e)
+
+        response.on_close = functools.partial(self.pool.release, scheme,
+            host, connection)
+        # Responses without a body, such as a 304, are complete already
+        if response.length == 0:
+            response.close()
+
+        # This mirrors urllib2.AbstractHTTPHandler.do_open()
+        response.recv = response.read
+        fp = socket._fileobject(response, close=True)
+        result = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        result.code = response.status
+        result.msg = response.reason
+        return result
 
 
 class UrlLib2Downloader():
     def __init__(self, settings):
         self.settings = settings
+        self.validators = {}
+        self.sha256 = None
 
-    def download(self, url, error_message, timeout, tries):
+    def download(self, url, error_message, timeout, tries, validators=None,
+            dest_path=None):
         if self.settings.get('http_proxy') or self.settings.get('https_proxy'):
             proxies = {}
             if self.settings.get('http_proxy'):
@@ -385,17 +732,49 @@ class UrlLib2Downloader():
             if self.settings.get('https_proxy'):
                 proxies['https'] = self.settings.get('https_proxy')
             proxy_handler = urllib2.ProxyHandler(proxies)
-            urllib2.install_opener(urllib2.build_opener(proxy_handler))
+            opener = urllib2.build_opener(proxy_handler)
+        else:
+            opener = urllib2.build_opener(KeepAliveHandler(_connection_pool))
+
+        if partial_size(dest_path):
+            os.remove(dest_path)
+        resume_from = 0
+        resumes = 0
 
         while tries > 0:
             tries -= 1
             try:
-                request = urllib2.Request(url, headers={"User-Agent":
-                    "Sublime Package Control"})
-                http_file = urllib2.urlopen(request, timeout=timeout)
+                headers = conditional_headers(validators)
+                headers["User-Agent"] = "Sublime Package Control"
+                if resume_from:
+                    headers['Range'] = 'bytes=%d-' % resume_from
+                    # If-Range makes the server send the whole file again
+                    # if it has changed since the partial download
+                    if_range = self.validators.get('etag') or \
+                        self.validators.get('last_modified')
+                    if if_range:
+                        headers['If-Range'] = if_range
+                request = urllib2.Request(url, headers=headers)
+                http_file = opener.open(request, timeout=timeout)
+                self.validators = {}
+                if http_file.headers.get('ETag'):
+                    self.validators['etag'] = http_file.headers['ETag']
+                if http_file.headers.get('Last-Modified'):
+                    self.validators['last_modified'] = \
+                        http_file.headers['Last-Modified']
+                if dest_path:
+                    return self.stream_to_file(http_file, dest_path,
+                        resume_from)
                 return http_file.read()
 
             except (urllib2.HTTPError) as (e):
+                if str(e.code) == '304':
+                    return NOT_MODIFIED
+                # The partial file can not be resumed, so start over
+                if str(e.code) == '416' and resume_from:
+                    os.remove(dest_path)
+                    resume_from = 0
+                    continue
                 # Bitbucket and Github ratelimit using 503 a decent amount
                 if str(e.code) == '503':
                     print (__name__ + ': Downloading %s was rate limited, ' +
@@ -414,25 +793,74 @@ class UrlLib2Downloader():
                 sublime.error_message(__name__ + ': ' + error_message +
                     ' URL error ' + str(e.reason) + ' downloading ' +
                     url + '.')
+            except (httplib.HTTPException, socket.error) as (e):
+                # The connection dropped part way through the transfer. The
+                # next try picks up where this one stopped, and does not
+                # count against the tries if some data was received.
+                if not dest_path:
+                    print (__name__ + ': Downloading %s was interrupted, ' +
+                        'trying again') % url
+                    continue
+                credit = resume_credit(dest_path, resume_from, resumes)
+                tries += credit
+                resumes += credit
+                resume_from = partial_size(dest_path)
+                print (__name__ + ': Downloading %s was interrupted, ' +
+                    'resuming from byte %d') % (url, resume_from)
+                continue
             break
         return False
 
+    def stream_to_file(self, http_file, dest_path, resume_from):
+        # Large packages are written to disk in chunks instead of being
+        # held in memory, and are hashed as they are written
+        if resume_from and http_file.code == 206:
+            mode = 'ab'
+            hash = hash_file(dest_path)
+        else:
+            mode = 'wb'
+            hash = hashlib.sha256()
+
+        received = 0
+        with open(dest_path, mode) as dest_file:
+            while True:
+                chunk = http_file.read(65536)
+                if not chunk:
+                    break
+                hash.update(chunk)
+                dest_file.write(chunk)
+                received += len(chunk)
+
+        # httplib returns a short read, instead of raising an error, when
+        # the server closes the connection early
+        length = http_file.headers.get('Content-Length')
+        if length and length.isdigit() and received < int(length):
+            raise httplib.IncompleteRead('')
+        self.sha256 = hash.hexdigest()
+        return True
+
 
 class WgetDownloader(CliDownloader):
     def __init__(self, settings):
         self.settings = settings
+        self.validators = {}
+        self.sha256 = None
         self.wget = self.find_binary('wget')
 
     def clean_tmp_file(self):
         os.remove(self.tmp_file)
 
-    def download(self, url, error_message, timeout, tries):
+    def download(self, url, error_message, timeout, tries, validators=None,
+            dest_path=None):
         if not self.wget:
             return False
 
         self.tmp_file = tempfile.NamedTemporaryFile().name
         command = [self.wget, '--connect-timeout=' + str(int(timeout)), '-o',
-            self.tmp_file, '-O', '-', '-U', 'Sublime Package Control', url]
+            self.tmp_file, '-O', dest_path or '-', '-U',
+            'Sublime Package Control', '-S']
+        for name, value in conditional_headers(validators).items():
+            command.append('--header=%s: %s' % (name, value))
 
         if self.settings.get('http_proxy'):
             os.putenv('http_proxy', self.settings.get('http_proxy'))
@@ -441,11 +869,25 @@ class WgetDownloader(CliDownloader):
         if self.settings.get('https_proxy'):
             os.putenv('https_proxy', self.settings.get('https_proxy'))
 
+        if partial_size(dest_path):
+            os.remove(dest_path)
+        resume_from = 0
+        resumes = 0
+
         while tries > 1:
             tries -= 1
             try:
-                result = self.execute(command)
+                # -c continues a partial download left by an earlier try
+                resume = []
+                if resume_from:
+                    resume = ['-c']
+                result = self.execute(command + resume + [url])
+                with open(self.tmp_file) as f:
+                    self.validators = self.parse_validators(list(f))
                 self.clean_tmp_file()
+                if dest_path:
+                    self.sha256 = hash_file(dest_path).hexdigest()
+                    return True
                 return result
             except (NonCleanExitError) as (e):
                 error_line = ''
@@ -457,6 +899,9 @@ class WgetDownloader(CliDownloader):
 
                 if e.returncode == 8:
                     regex = re.compile('^.*ERROR (\d+):.*', re.S)
+                    if re.sub(regex, '\\1', error_line) == '304':
+                        self.clean_tmp_file()
+                        return NOT_MODIFIED
                     if re.sub(regex, '\\1', error_line) == '503':
                         # GitHub and BitBucket seem to rate limit via 503
                         print (__name__ + ': Downloading %s was rate limited' +
@@ -472,6 +917,17 @@ class WgetDownloader(CliDownloader):
                         print (__name__ + ': Downloading %s timed out, ' +
                             'trying again') % url
                         continue
+                    # A dropped connection is resumed on the next try, which
+                    # does not count if some data was received
+                    if partial_size(dest_path):
+                        credit = resume_credit(dest_path, resume_from,
+                            resumes)
+                        tries += credit
+                        resumes += credit
+                        resume_from = partial_size(dest_path)
+                        print (__name__ + ': Downloading %s was interrupted' +
+                            ', resuming from byte %d') % (url, resume_from)
+                        continue
 
                 else:
                     error_string = re.sub('^.*?(ERROR[: ]|failed: )', '\\1',
@@ -489,13 +945,22 @@ class WgetDownloader(CliDownloader):
 class CurlDownloader(CliDownloader):
     def __init__(self, settings):
         self.settings = settings
+        self.validators = {}
+        self.sha256 = None
         self.curl = self.find_binary('curl')
 
-    def download(self, url, error_message, timeout, tries):
+    def download(self, url, error_message, timeout, tries, validators=None,
+            dest_path=None):
         if not self.curl:
             return False
+
+        header_file = tempfile.NamedTemporaryFile().name
         command = [self.curl, '-f', '--user-agent', 'Sublime Package Control',
-            '--connect-timeout', str(int(timeout)), '-sS', url]
+            '--connect-timeout', str(int(timeout)), '-sS', '-D', header_file]
+        if dest_path:
+            command.extend(['-o', dest_path])
+        for name, value in conditional_headers(validators).items():
+            command.extend(['-H', '%s: %s' % (name, value)])
 
         if self.settings.get('http_proxy'):
             os.putenv('http_proxy', self.settings.get('http_proxy'))
@@ -504,10 +969,33 @@ class CurlDownloader(CliDownloader):
         if self.settings.get('https_proxy'):
             os.putenv('HTTPS_PROXY', self.settings.get('https_proxy'))
 
+        if partial_size(dest_path):
+            os.remove(dest_path)
+        resume_from = 0
+        resumes = 0
+
         while tries > 1:
             tries -= 1
             try:
-                return self.execute(command)
+                # "-C -" continues a partial download left by an earlier try
+                resume = []
+                if resume_from:
+                    resume = ['-C', '-']
+                result = self.execute(command + resume + [url])
+                with open(header_file) as f:
+                    header_lines = list(f)
+                os.remove(header_file)
+
+                status_lines = [line for line in header_lines if
+                    re.match('^HTTP/\d', line)]
+                if status_lines and \
+                        re.match('^HTTP/\S+ 304', status_lines[-1]):
+                    return NOT_MODIFIED
+                self.validators = self.parse_validators(header_lines)
+                if dest_path:
+                    self.sha256 = hash_file(dest_path).hexdigest()
+                    return True
+                return result
             except (NonCleanExitError) as (e):
                 if e.returncode == 22:
                     code = re.sub('^.*?(\d+)\s*$', '\\1', e.output)
@@ -523,6 +1011,25 @@ class CurlDownloader(CliDownloader):
                     # GitHub and BitBucket seem to time out a lot
                     print (__name__ + ': Downloading %s timed out, trying ' +
                         'again') % url
+                    credit = resume_credit(dest_path, resume_from, resumes)
+                    tries += credit
+                    resumes += credit
+                    resume_from = partial_size(dest_path)
+                    continue
+                elif e.returncode in [18, 56] and partial_size(dest_path):
+                    # A dropped connection is resumed on the next try, which
+                    # does not count if some data was received
+                    credit = resume_credit(dest_path, resume_from, resumes)
+                    tries += credit
+                    resumes += credit
+                    resume_from = partial_size(dest_path)
+                    print (__name__ + ': Downloading %s was interrupted, ' +
+                        'resuming from byte %d') % (url, resume_from)
+                    continue
+                elif e.returncode == 33:
+                    # The server does not support ranges, so start over
+                    os.remove(dest_path)
+                    resume_from = 0
                     continue
                 else:
                     error_string = e.output
@@ -531,26 +1038,203 @@ class CurlDownloader(CliDownloader):
                     ' ' + error_string + ' downloading ' +
                     url + '.')
             break
+        if os.path.exists(header_file):
+            os.remove(header_file)
         return False
 
-_channel_repository_cache = {}
+class PersistentCache(dict):
+    # Entries are kept in memory, but the ones that are saved are also
+    # written to disk, one JSON file per key, so that channel and repository
+    # info survives restarting Sublime Text
+    def __init__(self):
+        dict.__init__(self)
+        self.cache_dir = None
+        self.lock = threading.Lock()
+
+    def get_cache_dir(self):
+        if not self.cache_dir:
+            self.cache_dir = os.path.join(sublime.packages_path(), 'User',
+                __name__ + '.cache')
+        return self.cache_dir
+
+    def get_filename(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.get_cache_dir(),
+            hashlib.md5(key).hexdigest() + '.json')
+
+    def get(self, key, default=None):
+        if key in self:
+            return dict.get(self, key)
+
+        filename = self.get_filename(key)
+        if not os.path.exists(filename):
+            return default
+        try:
+            with open(filename) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return default
+        # Protect against the very unlikely case of a hash collision
+        if entry.get('key') != key:
+            return default
+        del entry['key']
+        self[key] = entry
+        return entry
+
+    def save(self, key, entry):
+        self[key] = entry
+
+        with self.lock:
+            try:
+                if not os.path.exists(self.get_cache_dir()):
+                    os.makedirs(self.get_cache_dir())
+                filename = self.get_filename(key)
+                # Writing to a temp file and then moving it into place
+                # prevents a half-written file if Sublime Text is closed
+                tmp_filename = filename + '.tmp'
+                disk_entry = dict(entry)
+                disk_entry['key'] = key
+                with open(tmp_filename, 'w') as f:
+                    json.dump(disk_entry, f)
+                if os.name == 'nt' and os.path.exists(filename):
+                    os.remove(filename)
+                os.rename(tmp_filename, filename)
+            except (OSError, IOError) as (exception):
+                print '%s: Unable to save cache entry for %s. %s' % (
+                    __name__, key, str(exception))
+
+
+_channel_repository_cache = PersistentCache()
+
+class TransferCounter():
+    # Counts the bytes of channel and repository info downloaded, which is
+    # used to keep background refreshes within their budget
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = 0
+
+    def add(self, num_bytes):
+        with self.lock:
+            self.total += num_bytes
 
-class RepositoryDownloader(threading.Thread):
-    def __init__(self, package_manager, name_map, repo):
+
+_transfer_counter = TransferCounter()
+
+_background_refreshes = set()
+_background_refreshes_lock = threading.Lock()
+
+
+class ScheduledTask():
+    def __init__(self, domain, function, callback):
+        self.domain = domain
+        self.function = function
+        self.callback = callback
+        self.result = None
+        self.duration = None
+        self.done = threading.Event()
+
+    def run(self):
+        start = time.time()
+        try:
+            self.result = self.function()
+        except (Exception):
+            print '%s: Error running task for %s\n%s' % (__name__,
+                self.domain, traceback.format_exc())
+        self.duration = time.time() - start
+        self.done.set()
+        if self.callback:
+            self.callback(self.result)
+
+    def wait(self):
+        self.done.wait()
+        return self.result
+
+
+class TaskScheduler():
+    # Runs tasks on a bounded set of worker threads. No more than
+    # max_per_domain tasks for a single domain run at once so that servers
+    # such as GitHub and BitBucket do not rate limit us.
+    def __init__(self, max_workers, max_per_domain):
+        self.max_workers = max_workers
+        self.max_per_domain = max_per_domain
+        self.condition = threading.Condition()
+        self.pending = []
+        self.running = {}
+        self.workers = 0
+
+    def set_limits(self, max_workers, max_per_domain):
+        with self.condition:
+            self.max_workers = max(1, int(max_workers))
+            self.max_per_domain = max(1, int(max_per_domain))
+            self.condition.notify_all()
+
+    def submit(self, domain, function, callback=None):
+        task = ScheduledTask(domain, function, callback)
+        with self.condition:
+            self.pending.append(task)
+            if self.workers < self.max_workers:
+                self.workers += 1
+                worker = threading.Thread(target=self.work)
+                worker.setDaemon(True)
+                worker.start()
+            else:
+                self.condition.notify()
+        return task
+
+    def next_task(self):
+        for task in self.pending:
+            if self.running.get(task.domain, 0) < self.max_per_domain:
+                self.pending.remove(task)
+                self.running[task.domain] = \
+                    self.running.get(task.domain, 0) + 1
+                return task
+        return None
+
+    def work(self):
+        while True:
+            with self.condition:
+                task = self.next_task()
+                while not task:
+                    # Workers exit once there is nothing left to do, or when
+                    # the limits have been lowered below the current number
+                    if not self.pending or self.workers > self.max_workers:
+                        self.workers -= 1
+                        return
+                    self.condition.wait()
+                    task = self.next_task()
+
+            task.run()
+
+            with self.condition:
+                self.running[task.domain] -= 1
+                if not self.running[task.domain]:
+                    del self.running[task.domain]
+                self.condition.notify_all()
+
+
+_task_scheduler = TaskScheduler(8, 4)
+
+
+class RepositoryDownloader():
+    def __init__(self, package_manager, name_map, repo, validators=None):
         self.package_manager = package_manager
         self.repo = repo
         self.packages = {}
         self.name_map = name_map
-        threading.Thread.__init__(self)
+        if validators == None:
+            validators = {}
+        self.validators = validators
 
     def run(self):
         for provider_class in _package_providers:
             provider = provider_class()
             if provider.match_url(self.repo):
                 break
-        packages = provider.get_packages(self.repo, self.package_manager)
-        if packages == False:
-            self.packages = False
+        packages = provider.get_packages(self.repo, self.package_manager,
+            self.validators)
+        if packages == False or packages == NOT_MODIFIED:
+            self.packages = packages
             return
 
         mapped_packages = {}
@@ -576,11 +1260,12 @@ class VcsUpgrader():
             startupinfo = subprocess.STARTUPINFO()
             startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-        proc = subprocess.Popen(args, stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            startupinfo=startupinfo, cwd=dir)
+        with _tracer.span('vcs', ' '.join(args[1:]), cwd=dir):
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                startupinfo=startupinfo, cwd=dir)
 
-        return proc.stdout.read().replace('\r\n', '\n').rstrip(' \n\r')
+            return proc.stdout.read().replace('\r\n', '\n').rstrip(' \n\r')
 
     def find_binary(self, name):
         if self.binary:
@@ -652,16 +1337,31 @@ class GitUpgrader(VcsUpgrader):
         binary = self.retrieve_binary()
         if not binary:
             return False
-        self.execute([binary, 'fetch'], self.working_copy)
-        args = [binary, 'log']
-        args.append('..' + '/'.join(self.update_command[-2:]))
-        output = self.execute(args, self.working_copy)
-        incoming = len(output) > 0
 
-        _channel_repository_cache[cache_key] = {
+        # ls-remote only asks the remote for the head of the branch, so
+        # a full fetch is only done when the branch has actually moved
+        remote, branch = self.update_command[-2:]
+        remote_head = self.execute([binary, 'ls-remote', remote,
+            'refs/heads/' + branch], self.working_copy).split('\t')[0]
+        local_head = self.execute([binary, 'rev-parse', 'HEAD'],
+            self.working_copy)
+        tracking_head = self.execute([binary, 'rev-parse',
+            remote + '/' + branch], self.working_copy)
+
+        if remote_head and remote_head == local_head:
+            incoming = False
+        else:
+            if not remote_head or remote_head != tracking_head:
+                self.execute([binary, 'fetch'], self.working_copy)
+            args = [binary, 'log']
+            args.append('..' + '/'.join(self.update_command[-2:]))
+            output = self.execute(args, self.working_copy)
+            incoming = len(output) > 0
+
+        _channel_repository_cache.save(cache_key, {
             'time': time.time() + self.cache_length,
             'data': incoming
-        }
+        })
         return incoming
 
 
@@ -709,13 +1409,496 @@ class HgUpgrader(VcsUpgrader):
         output = self.execute(args, self.working_copy)
         incoming = len(output) > 0
 
-        _channel_repository_cache[cache_key] = {
+        _channel_repository_cache.save(cache_key, {
             'time': time.time() + self.cache_length,
             'data': incoming
-        }
+        })
         return incoming
 
 
+_version_keys = {}
+
+
+# Parses a version string into a tuple that sorts in version order. Keys are
+# memoized since the same versions are compared over and over again.
+def version_key(version):
+    key = _version_keys.get(version)
+    if key == None:
+        key = tuple([int(part) if part.isdigit() else part for part in
+            re.sub(r'(\.0+)*$', '', version).split('.')])
+        _version_keys[version] = key
+    return key
+
+
+class PackageCatalog():
+    # An index of the available packages that is kept between commands and
+    # only re-indexes the packages whose info changed when repositories are
+    # refreshed. Metadata for installed packages is also kept here so that
+    # building the quick panel does not read package-metadata.json files.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.sorted_names = []
+        self.metadata = {}
+
+    def tokenize(self, text):
+        if not text:
+            return []
+        return [token for token in re.split('[^a-z0-9]+', text.lower())
+            if token]
+
+    def update(self, packages):
+        with self.lock:
+            names_changed = False
+            for name in self.entries.keys():
+                if name not in packages:
+                    del self.entries[name]
+                    names_changed = True
+
+            for name, info in packages.items():
+                entry = self.entries.get(name)
+                # Package info dicts are shared with the cache, so the same
+                # object means the info has not been refreshed
+                if entry and entry['info'] is info:
+                    continue
+                if not entry:
+                    names_changed = True
+                description = info.get('description') or ''
+                author = info.get('author') or ''
+                # Word starts are used to rank acronym style queries
+                word_starts = set([0] + [match.start() for match in
+                    re.finditer('[A-Z]|(?<=[^A-Za-z0-9])[A-Za-z0-9]', name)])
+                version = info['downloads'][0].get('version') if \
+                    info.get('downloads') else None
+                self.entries[name] = {
+                    'info': info,
+                    'version_key': version_key(version) if version else None,
+                    'name': name.lower(),
+                    'word_starts': word_starts,
+                    'description': description.lower(),
+                    'tokens': set(self.tokenize(name) +
+                        self.tokenize(description) + self.tokenize(author))
+                }
+
+            if names_changed:
+                self.sorted_names = sorted(self.entries.keys())
+
+    def get_metadata(self, package_manager, package):
+        with self.lock:
+            if package in self.metadata:
+                return self.metadata[package]
+        metadata = package_manager.get_metadata(package)
+        if metadata.get('version'):
+            metadata['version_key'] = version_key(metadata['version'])
+        with self.lock:
+            self.metadata[package] = metadata
+        return metadata
+
+    def get_version_key(self, package):
+        with self.lock:
+            entry = self.entries.get(package)
+            if not entry:
+                return None
+            return entry['version_key']
+
+    def clear_metadata(self, package):
+        with self.lock:
+            if package in self.metadata:
+                del self.metadata[package]
+
+    def score(self, entry, query, query_tokens):
+        name = entry['name']
+        if name == query:
+            return 100
+        if name.startswith(query):
+            return 80
+        if query in name:
+            return 60
+        if query_tokens and all(any(token.startswith(query_token) for
+                token in entry['tokens']) for query_token in query_tokens):
+            return 40
+
+        # Fuzzy match the query as a subsequence of the name, preferring
+        # matches where the characters are close together or start words
+        position = -1
+        gaps = 0
+        for char in query:
+            next_position = name.find(char, position + 1)
+            if next_position == -1:
+                break
+            if position != -1:
+                gaps += next_position - position - 1
+            if next_position in entry['word_starts']:
+                gaps -= 2
+            position = next_position
+        else:
+            return min(39, max(21, 39 - gaps))
+
+        if query in entry['description']:
+            return 10
+        return 0
+
+    def search(self, query, limit=None):
+        query = query.strip().lower()
+        if not query:
+            return []
+        query_tokens = self.tokenize(query)
+        with self.lock:
+            matches = []
+            for name in self.sorted_names:
+                score = self.score(self.entries[name], query, query_tokens)
+                if score:
+                    matches.append((-score, name))
+        matches.sort()
+        names = [name for score, name in matches]
+        if limit:
+            names = names[0:limit]
+        return names
+
+
+_package_catalog = PackageCatalog()
+
+
+class DirectorySnapshot():
+    # Caches a single listing pass over the Packages, Pristine Packages and
+    # Installed Packages dirs. A listing is reused until the mtime of the
+    # dir changes, or it is explicitly invalidated after Package Control
+    # changes something that would not touch the mtime, such as writing
+    # a cleanup file inside of a package dir.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = {}
+
+    def scan(self, path):
+        names = os.listdir(path)
+        dirs = []
+        cleanup = []
+        for name in names:
+            full_path = os.path.join(path, name)
+            if not os.path.isdir(full_path):
+                continue
+            dirs.append(name)
+            if os.path.exists(os.path.join(full_path,
+                    'package-control.cleanup')):
+                cleanup.append(name)
+        names.sort()
+        return {'names': names, 'dirs': dirs, 'cleanup': cleanup}
+
+    def get(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except (OSError):
+            return {'names': [], 'dirs': [], 'cleanup': []}
+
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing and listing['mtime'] == mtime:
+                return listing['data']
+
+        data = self.scan(path)
+        with self.lock:
+            self.listings[path] = {'mtime': mtime, 'data': data}
+        return data
+
+    def invalidate(self, path=None):
+        with self.lock:
+            if path == None:
+                self.listings = {}
+            elif path in self.listings:
+                del self.listings[path]
+
+
+_directory_snapshot = DirectorySnapshot()
+
+
+class PackageArchiver():
+    # Builds .sublime-package files. Members are read and deflated on a
+    # TaskScheduler, and are appended to the archive in sorted order with a
+    # fixed timestamp so that the same package dir always produces an
+    # identical file. zipfile can only add members by compressing them
+    # itself, so the zip records are written here.
+    date_time = (1980, 1, 1, 0, 0, 0)
+    local_header = '<4s2B4HL2L2H'
+    central_header = '<4s4B4HL2L5H2L'
+    end_record = '<4s4H2LH'
+
+    def __init__(self, dirs_to_ignore, files_to_ignore, threads=4):
+        self.dirs_to_ignore = set(dirs_to_ignore)
+        self.ignore_regex = None
+        if files_to_ignore:
+            self.ignore_regex = re.compile('|'.join([fnmatch.translate(
+                os.path.normcase(pattern)) for pattern in files_to_ignore]))
+        self.threads = max(1, int(threads))
+
+    def is_ignored(self, filename):
+        if not self.ignore_regex:
+            return False
+        return self.ignore_regex.match(os.path.normcase(filename)) != None
+
+    def list_files(self, package_dir, always_include=[]):
+        files = {}
+        for root, dirs, filenames in os.walk(package_dir):
+            dirs[:] = [dir for dir in dirs if dir not in self.dirs_to_ignore]
+            relative_root = os.path.relpath(root, package_dir)
+            for filename in filenames:
+                relative_path = os.path.normpath(os.path.join(relative_root,
+                    filename))
+                if self.is_ignored(filename) and \
+                        relative_path not in always_include:
+                    continue
+                files[relative_path.replace(os.sep, '/')] = os.path.join(
+                    root, filename)
+        return [(files[name], name) for name in sorted(files.keys())]
+
+    def deflate(self, full_path):
+        with open(full_path, 'rb') as f:
+            data = f.read()
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+            zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        return {'mode': os.stat(full_path).st_mode,
+            'crc': zlib.crc32(data) & 0xFFFFFFFF, 'size': len(data),
+            'data': compressed}
+
+    def encode_name(self, name):
+        # Returns the name as stored in the archive and its flag bits
+        if isinstance(name, unicode):
+            try:
+                return (name.encode('ascii'), 0)
+            except (UnicodeEncodeError):
+                return (name.encode('utf-8'), 0x800)
+        return (name, 0)
+
+    def write(self, package_path, files):
+        # Only a couple of members per thread are deflated ahead of the one
+        # being written, so a large package is never held in memory all at
+        # once
+        scheduler = TaskScheduler(self.threads, self.threads)
+        files = iter(files)
+        tasks = []
+
+        def deflate_next():
+            for full_path, name in files:
+                tasks.append((name, scheduler.submit(package_path,
+                    functools.partial(self.deflate, full_path))))
+                return
+
+        for i in range(self.threads * 2):
+            deflate_next()
+
+        year, month, day, hour, minute, second = self.date_time
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        dos_time = hour << 11 | minute << 5 | second // 2
+
+        entries = []
+        with open(package_path, 'wb') as package_file:
+            while tasks:
+                name, task = tasks.pop(0)
+                deflate_next()
+                member = task.wait()
+                if member == None:
+                    raise IOError('Unable to read %s' % name)
+                offset = package_file.tell()
+                if max(member['size'], len(member['data']), offset) > \
+                        0xFFFFFFFF or len(entries) >= 0xFFFF:
+                    raise zipfile.LargeZipFile(
+                        'Package is too large to build')
+                filename, flags = self.encode_name(name)
+                package_file.write(struct.pack(self.local_header,
+                    'PK\003\004', 20, 0, flags, zipfile.ZIP_DEFLATED,
+                    dos_time, dos_date, member['crc'], len(member['data']),
+                    member['size'], len(filename), 0))
+                package_file.write(filename)
+                package_file.write(member['data'])
+                # Files are recorded as made on unix so the modes are kept
+                entries.append(struct.pack(self.central_header,
+                    'PK\001\002', 20, 3, 20, 0, flags,
+                    zipfile.ZIP_DEFLATED, dos_time, dos_date, member['crc'],
+                    len(member['data']), member['size'], len(filename), 0, 0,
+                    0, 0, (member['mode'] & 0xFFFF) << 16L, offset) +
+                    filename)
+
+            directory_offset = package_file.tell()
+            directory = ''.join(entries)
+            if directory_offset + len(directory) > 0xFFFFFFFF:
+                raise zipfile.LargeZipFile('Package is too large to build')
+            package_file.write(directory)
+            package_file.write(struct.pack(self.end_record, 'PK\005\006',
+                0, 0, len(entries), len(entries), len(directory),
+                directory_offset, 0))
+
+
+class BackupStore():
+    # Backups are stored by content, so each version of a file is only
+    # kept once no matter how many backups include it. objects/ holds the
+    # file contents named by SHA-1, and snapshots/ holds one small JSON
+    # manifest per backup mapping each path to its content hash.
+    def __init__(self, backup_dir):
+        self.backup_dir = backup_dir
+        self.objects_dir = os.path.join(backup_dir, 'objects')
+        self.snapshots_dir = os.path.join(backup_dir, 'snapshots')
+        self.imported_legacy = False
+
+    def get_object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[0:2], digest[2:])
+
+    def hash_file(self, path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def store_object(self, path, digest):
+        object_path = self.get_object_path(digest)
+        if os.path.exists(object_path):
+            return
+        if not os.path.exists(os.path.dirname(object_path)):
+            os.makedirs(os.path.dirname(object_path))
+        tmp_path = object_path + '.tmp'
+        shutil.copy2(path, tmp_path)
+        os.rename(tmp_path, object_path)
+
+    # Older versions copied each package into Backup/<timestamp>/<package>.
+    # Those backups are moved into the store the first time it is used, and
+    # the old copies are only removed once they have been stored.
+    def import_legacy(self):
+        if self.imported_legacy or not os.path.exists(self.backup_dir):
+            return
+        self.imported_legacy = True
+        for timestamp in sorted(os.listdir(self.backup_dir)):
+            legacy_dir = os.path.join(self.backup_dir, timestamp)
+            if not re.match('^\d{14}$', timestamp) or \
+                    not os.path.isdir(legacy_dir):
+                continue
+            try:
+                for package_name in os.listdir(legacy_dir):
+                    package_dir = os.path.join(legacy_dir, package_name)
+                    name = '%s-%s' % (timestamp, package_name)
+                    if os.path.isdir(package_dir) and not os.path.exists(
+                            os.path.join(self.snapshots_dir, name + '.json')):
+                        self.snapshot(package_name, package_dir, timestamp)
+                shutil.rmtree(legacy_dir)
+            except (OSError, IOError) as (exception):
+                print '%s: Unable to import the backup %s. %s' % (__name__,
+                    legacy_dir, str(exception))
+
+    def list_snapshots(self, package_name=None):
+        self.import_legacy()
+        if not os.path.exists(self.snapshots_dir):
+            return []
+        snapshots = []
+        for filename in os.listdir(self.snapshots_dir):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.snapshots_dir, filename)) as f:
+                    snapshot = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if package_name and snapshot['package'] != package_name:
+                continue
+            snapshot['name'] = filename[0:-5]
+            snapshots.append(snapshot)
+        snapshots.sort(key=lambda snapshot: snapshot['name'], reverse=True)
+        return snapshots
+
+    def snapshot(self, package_name, package_dir, timestamp=None):
+        # Files with the same size and mtime as in the previous backup of
+        # the package are not hashed again
+        previous = self.list_snapshots(package_name)
+        previous_files = previous[0]['files'] if previous else {}
+
+        files = {}
+        for root, dirs, filenames in os.walk(package_dir):
+            for filename in filenames:
+                full_path = os.path.join(root, filename)
+                relative_path = os.path.relpath(full_path,
+                    package_dir).replace(os.sep, '/')
+                stat = os.stat(full_path)
+                entry = previous_files.get(relative_path)
+                if entry and entry[1] == stat.st_size and \
+                        entry[2] == stat.st_mtime and \
+                        os.path.exists(self.get_object_path(entry[0])):
+                    digest = entry[0]
+                else:
+                    digest = self.hash_file(full_path)
+                    self.store_object(full_path, digest)
+                files[relative_path] = [digest, stat.st_size, stat.st_mtime,
+                    stat.st_mode & 0777]
+
+        if not os.path.exists(self.snapshots_dir):
+            os.makedirs(self.snapshots_dir)
+        if not timestamp:
+            timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        name = '%s-%s' % (timestamp, package_name)
+        suffix = 1
+        while os.path.exists(os.path.join(self.snapshots_dir,
+                name + '.json')):
+            suffix += 1
+            name = '%s.%s-%s' % (timestamp, suffix, package_name)
+        with open(os.path.join(self.snapshots_dir, name + '.json'), 'w') as f:
+            json.dump({'package': package_name, 'time': timestamp,
+                'files': files}, f)
+        return name
+
+    def restore(self, name, package_dir):
+        snapshot_path = os.path.join(self.snapshots_dir, name + '.json')
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+
+        # The current state is backed up first so a restore can be undone
+        if os.path.exists(package_dir):
+            self.snapshot(snapshot['package'], package_dir)
+            for path in os.listdir(package_dir):
+                full_path = os.path.join(package_dir, path)
+                if os.path.isdir(full_path):
+                    shutil.rmtree(full_path)
+                else:
+                    os.remove(full_path)
+
+        for relative_path, entry in snapshot['files'].items():
+            dest = os.path.join(package_dir, *relative_path.split('/'))
+            if not os.path.exists(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.copy2(self.get_object_path(entry[0]), dest)
+            # Objects are shared between files, so the mode and mtime are
+            # set from the snapshot. Older snapshots did not record modes.
+            if len(entry) > 3:
+                os.chmod(dest, entry[3])
+            os.utime(dest, (entry[2], entry[2]))
+        return snapshot['package']
+
+    def prune(self, retention):
+        if not retention:
+            return
+
+        kept = {}
+        referenced = set()
+        for snapshot in self.list_snapshots():
+            count = kept.get(snapshot['package'], 0)
+            if count >= retention:
+                os.remove(os.path.join(self.snapshots_dir,
+                    snapshot['name'] + '.json'))
+                continue
+            kept[snapshot['package']] = count + 1
+            for entry in snapshot['files'].values():
+                referenced.add(entry[0])
+
+        if not os.path.exists(self.objects_dir):
+            return
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for filename in os.listdir(prefix_dir):
+                if prefix + filename not in referenced:
+                    os.remove(os.path.join(prefix_dir, filename))
+            if not os.listdir(prefix_dir):
+                os.rmdir(prefix_dir)
+
+
 class PackageManager():
     def __init__(self):
         self.printer = PanelPrinter.get()
@@ -729,20 +1912,34 @@ class PackageManager():
                 'files_to_ignore_binary', 'files_to_keep', 'dirs_to_keep',
                 'git_binary', 'git_update_command', 'hg_binary',
                 'hg_update_command', 'http_proxy', 'https_proxy',
-                'auto_upgrade_ignore', 'auto_upgrade_frequency']:
+                'auto_upgrade_ignore', 'auto_upgrade_frequency',
+                'max_concurrent_downloads',
+                'max_concurrent_downloads_per_domain', 'delta_upgrades',
+                'backup_retention', 'package_build_threads',
+                'background_refresh', 'background_refresh_budget',
+                'trace_file']:
             if settings.get(setting) == None:
                 continue
             self.settings[setting] = settings.get(setting)
+        _tracer.set_trace_file(self.settings.get('trace_file'))
 
     def compare_versions(self, version1, version2):
-        def normalize(v):
-            return [int(x) for x in re.sub(r'(\.0+)*$','', v).split(".")]
-        return cmp(normalize(version1), normalize(version2))
-
-    def download_url(self, url, error_message):
+        return cmp(version_key(version1), version_key(version2))
+
+    # Returns the versions from a messages.json file that are newer than
+    # the version specified, newest first
+    def list_messages_since(self, message_info, version):
+        since_key = version_key(version)
+        versions = [message_version for message_version in
+            message_info.keys() if message_version != 'install' and
+            version_key(message_version) > since_key]
+        return sorted(versions, key=version_key, reverse=True)
+
+    def get_downloader(self, url):
         has_ssl = 'ssl' in sys.modules
         is_ssl = re.search('^https://', url) != None
 
+        downloader = None
         if (is_ssl and has_ssl) or not is_ssl:
             downloader = UrlLib2Downloader(self.settings)
         else:
@@ -757,11 +1954,63 @@ class PackageManager():
             sublime.error_message(__name__ + ': Unable to download ' +
                 url + ' due to no ssl module available and no capable ' +
                 'program found. Please install curl or wget.')
+        return downloader
+
+    # If a dict of validators is passed, any validators stored for the url
+    # are used to make a conditional request, and the validators from the
+    # response are stored back into the dict for the next request
+    def download_url(self, url, error_message, validators=None):
+        downloader = self.get_downloader(url)
+        if not downloader:
             return False
 
         timeout = self.settings.get('timeout', 3)
-        return downloader.download(url.replace(' ', '%20'), error_message,
-            timeout, 3)
+        with _tracer.span('download', url,
+                downloader=downloader.__class__.__name__) as span:
+            if validators == None:
+                result = downloader.download(url.replace(' ', '%20'),
+                    error_message, timeout, 3)
+            else:
+                result = downloader.download(url.replace(' ', '%20'),
+                    error_message, timeout, 3, validators.get(url))
+                if result != False and result != NOT_MODIFIED:
+                    validators[url] = downloader.validators
+
+            if result == False:
+                span.set(result='error')
+            elif result == NOT_MODIFIED:
+                span.set(result='not modified')
+            else:
+                span.set(result='ok', bytes=len(result))
+                _transfer_counter.add(len(result))
+        return result
+
+    # If a sha256 hex digest is passed, the downloaded file is verified
+    # against it and removed if it does not match
+    def download_url_to_file(self, url, dest_path, error_message,
+            sha256=None):
+        downloader = self.get_downloader(url)
+        if not downloader:
+            return False
+
+        timeout = self.settings.get('timeout', 3)
+        with _tracer.span('download', url,
+                downloader=downloader.__class__.__name__) as span:
+            result = downloader.download(url.replace(' ', '%20'),
+                error_message, timeout, 3, dest_path=dest_path)
+            if result == False:
+                span.set(result='error')
+            else:
+                span.set(result='ok', bytes=os.path.getsize(dest_path))
+        if result != False and sha256 and \
+                downloader.sha256 != sha256.lower():
+            sublime.error_message(__name__ + ': ' + error_message +
+                ' The file downloaded from ' + url + ' does not match the ' +
+                'published sha256 hash.')
+            result = False
+        if result == False and os.path.exists(dest_path):
+            os.remove(dest_path)
+        return result
 
     def get_metadata(self, package):
         metadata_filename = os.path.join(self.get_package_dir(package),
@@ -774,128 +2023,164 @@ class PackageManager():
                     return {}
         return {}
 
+    def get_domain(self, url):
+        return re.sub('^https?://[^/]*?(\w+\.\w+)($|/.*$)', '\\1', url)
+
+    def get_scheduler(self):
+        _task_scheduler.set_limits(
+            self.settings.get('max_concurrent_downloads', 8),
+            self.settings.get('max_concurrent_downloads_per_domain', 4))
+        return _task_scheduler
+
+    def refresh_in_background(self, cache_key, url, refresh):
+        with _background_refreshes_lock:
+            if cache_key in _background_refreshes:
+                return
+            _background_refreshes.add(cache_key)
+
+        def done(result):
+            with _background_refreshes_lock:
+                _background_refreshes.discard(cache_key)
+        self.get_scheduler().submit(self.get_domain(url), refresh, done)
+
+    def fetch_channel(self, channel, channel_cache=None):
+        # Conditional requests are only made when there is info to fall
+        # back on if the channel has not been modified
+        validators = {}
+        if channel_cache:
+            validators = dict(channel_cache.get('validators', {}))
+
+        for provider_class in _channel_providers:
+            provider = provider_class(channel, self, validators)
+            if provider.match_url(channel):
+                break
+        channel_repositories = provider.get_repositories()
+        if channel_repositories == False:
+            return False
+
+        if channel_repositories == NOT_MODIFIED:
+            channel_cache = dict(channel_cache)
+        else:
+            channel_cache = {
+                'data': channel_repositories,
+                'name_map': provider.get_name_map()
+            }
+        channel_cache['time'] = time.time() + \
+            self.settings.get('cache_length', 300)
+        channel_cache['validators'] = validators
+        _channel_repository_cache.save(channel + '.repositories',
+            channel_cache)
+        return channel_cache
+
+    def record_cache_lookup(self, cache_key, cache_entry):
+        _tracer.record('cache', cache_key, hit=cache_entry != None,
+            stale=cache_entry != None and
+                cache_entry.get('time') <= time.time())
+
     def list_repositories(self):
-        repositories = self.settings.get('repositories')
-        repository_channels = self.settings.get('repository_channels')
+        repositories = list(self.settings.get('repositories', []))
+        repository_channels = self.settings.get('repository_channels', [])
         for channel in repository_channels:
-            channel_repositories = None
-
             cache_key = channel + '.repositories'
-            repositories_cache = _channel_repository_cache.get(cache_key)
-            if repositories_cache and repositories_cache.get('time') > \
-                    time.time():
-                channel_repositories = repositories_cache.get('data')
-
-            if not channel_repositories:
-                for provider_class in _channel_providers:
-                    provider = provider_class(channel, self)
-                    if provider.match_url(channel):
-                        break
-                channel_repositories = provider.get_repositories()
-                if channel_repositories == False:
+            channel_cache = _channel_repository_cache.get(cache_key)
+            self.record_cache_lookup(cache_key, channel_cache)
+
+            # Expired info is still used so that nothing has to wait on the
+            # network, but it is refreshed in the background for next time
+            if channel_cache and channel_cache.get('time') <= time.time():
+                self.refresh_in_background(cache_key, channel,
+                    functools.partial(self.fetch_channel, channel,
+                    channel_cache))
+
+            if not channel_cache:
+                channel_cache = self.fetch_channel(channel)
+                if channel_cache == False:
                     continue
-                _channel_repository_cache[cache_key] = {
-                    'time': time.time() + self.settings.get('cache_length',
-                        300),
-                    'data': channel_repositories
-                }
-                # Have the local name map override the one from the channel
-                name_map = provider.get_name_map()
-                name_map.update(self.settings['package_name_map'])
-                self.settings['package_name_map'] = name_map
 
-            repositories.extend(channel_repositories)
+            # Have the local name map override the one from the channel
+            name_map = dict(channel_cache.get('name_map', {}))
+            name_map.update(self.settings.get('package_name_map', {}))
+            self.settings['package_name_map'] = name_map
+
+            repositories.extend(channel_cache.get('data'))
         return repositories
 
+    def cache_repository(self, downloader, repository_cache=None):
+        repository_packages = downloader.packages
+        if repository_packages == False:
+            return False
+        if repository_packages == NOT_MODIFIED:
+            repository_cache = dict(repository_cache)
+        else:
+            repository_cache = {'data': repository_packages}
+        repository_cache['time'] = time.time() + \
+            self.settings.get('cache_length', 300)
+        repository_cache['validators'] = downloader.validators
+        _channel_repository_cache.save(downloader.repo + '.packages',
+            repository_cache)
+        return repository_cache
+
+    def fetch_repository(self, repo, repository_cache=None):
+        # Conditional requests are only made when there is info to fall
+        # back on if the repository has not been modified
+        validators = {}
+        if repository_cache:
+            validators = dict(repository_cache.get('validators', {}))
+
+        downloader = RepositoryDownloader(self,
+            self.settings.get('package_name_map', {}), repo, validators)
+        downloader.run()
+        return self.cache_repository(downloader, repository_cache)
+
     def list_available_packages(self):
         repositories = self.list_repositories()
-        packages = {}
-        downloaders = []
-        grouped_downloaders = {}
+        scheduler = self.get_scheduler()
+        results = []
 
         # Repositories are run in reverse order so that the ones first
         # on the list will overwrite those last on the list
         for repo in repositories[::-1]:
-            repository_packages = None
-
             cache_key = repo + '.packages'
             packages_cache = _channel_repository_cache.get(cache_key)
-            if packages_cache and packages_cache.get('time') > \
-                    time.time():
-                repository_packages = packages_cache.get('data')
-                packages.update(repository_packages)
-
-            if repository_packages == None:
-                downloader = RepositoryDownloader(self,
-                    self.settings.get('package_name_map', {}), repo)
-                domain = re.sub('^https?://[^/]*?(\w+\.\w+)($|/.*$)', '\\1',
-                    repo)
-                if not grouped_downloaders.get(domain):
-                    grouped_downloaders[domain] = []
-                grouped_downloaders[domain].append(downloader)
-
-        def schedule(downloader, delay):
-            downloader.has_started = False
-            def inner():
-                downloader.start()
-                downloader.has_started = True
-            sublime.set_timeout(inner, delay)
-
-        for domain_downloaders in grouped_downloaders.values():
-            for i in range(len(domain_downloaders)):
-                downloader = domain_downloaders[i]
-                downloaders.append(downloader)
-                schedule(downloader, i * 150)
-
-        complete = []
-
-        while downloaders:
-            downloader = downloaders.pop()
-            if downloader.has_started:
-                downloader.join()
-                complete.append(downloader)
-            else:
-                downloaders.insert(0, downloader)
+            self.record_cache_lookup(cache_key, packages_cache)
+            if packages_cache:
+                results.append(packages_cache)
+                if packages_cache.get('time') <= time.time():
+                    self.refresh_in_background(cache_key, repo,
+                        functools.partial(self.fetch_repository, repo,
+                        packages_cache))
+                continue
 
-        for downloader in complete:
-            repository_packages = downloader.packages
-            if repository_packages == False:
+            results.append(scheduler.submit(self.get_domain(repo),
+                functools.partial(self.fetch_repository, repo)))
+
+        packages = {}
+        for result in results:
+            if isinstance(result, ScheduledTask):
+                result = result.wait()
+            if not result:
                 continue
-            cache_key = downloader.repo + '.packages'
-            _channel_repository_cache[cache_key] = {
-                'time': time.time() + self.settings.get('cache_length', 300),
-                'data': repository_packages
-            }
-            packages.update(repository_packages)
+            packages.update(result['data'])
 
+        _package_catalog.update(packages)
         return packages
 
     def list_packages(self):
-        package_names = os.listdir(sublime.packages_path())
-        package_names = [path for path in package_names if
-            os.path.isdir(os.path.join(sublime.packages_path(), path))]
+        listing = _directory_snapshot.get(sublime.packages_path())
         # Ignore things to be deleted
-        ignored_packages = []
-        for package in package_names:
-            cleanup_file = os.path.join(sublime.packages_path(), package,
-                'package-control.cleanup')
-            if os.path.exists(cleanup_file):
-                ignored_packages.append(package)
-        packages = list(set(package_names) - set(ignored_packages) -
+        packages = list(set(listing['dirs']) - set(listing['cleanup']) -
             set(self.list_default_packages()))
         packages.sort()
         return packages
 
     def list_all_packages(self):
-        packages = os.listdir(sublime.packages_path())
-        packages.sort()
-        return packages
+        return list(_directory_snapshot.get(sublime.packages_path())['names'])
 
     def list_default_packages(self):
-        files = os.listdir(os.path.join(os.path.dirname(
-            sublime.packages_path()), 'Pristine Packages'))
-        files = list(set(files) - set(os.listdir(
-            sublime.installed_packages_path())))
+        files = _directory_snapshot.get(os.path.join(os.path.dirname(
+            sublime.packages_path()), 'Pristine Packages'))['names']
+        files = list(set(files) - set(_directory_snapshot.get(
+            sublime.installed_packages_path())['names']))
         packages = [file.replace('.sublime-package', '') for file in files]
         packages.sort()
         return packages
@@ -903,6 +2188,10 @@ class PackageManager():
     def get_package_dir(self, package):
         return os.path.join(sublime.packages_path(), package)
 
+    def get_backup_store(self):
+        return BackupStore(os.path.join(os.path.dirname(
+            sublime.packages_path()), 'Backup'))
+
     def get_mapped_name(self, package):
         return self.settings.get('package_name_map', {}).get(package, package)
 
@@ -926,59 +2215,148 @@ class PackageManager():
         if os.path.exists(package_path):
             os.remove(package_path)
 
-        try:
-            package_file = zipfile.ZipFile(package_path, "w",
-                compression=zipfile.ZIP_DEFLATED)
-        except (OSError, IOError) as (exception):
-            sublime.error_message(__name__ + ': An error occurred ' +
-                'creating the package file %s in %s. %s' % (package_filename,
-                package_destination, str(exception)))
-            return False
-
         dirs_to_ignore = self.settings.get('dirs_to_ignore', [])
         if not binary_package:
             files_to_ignore = self.settings.get('files_to_ignore', [])
         else:
             files_to_ignore = self.settings.get('files_to_ignore_binary', [])
 
-        package_dir_regex = re.compile('^' + re.escape(package_dir))
-        for root, dirs, files in os.walk(package_dir):
-            [dirs.remove(dir) for dir in dirs if dir in dirs_to_ignore]
-            paths = dirs
-            paths.extend(files)
-            for path in paths:
-                if any(fnmatch.fnmatch(path, pattern) for pattern in
-                        files_to_ignore):
-                    continue
-                full_path = os.path.join(root, path)
-                relative_path = re.sub(package_dir_regex, '', full_path)
-                if os.path.isdir(full_path):
-                    continue
-                package_file.write(full_path, relative_path)
+        # Binary packages always include the __init__.py file
+        always_include = []
+        if binary_package:
+            always_include.append('__init__.py')
 
-        init_script = os.path.join(package_dir, '__init__.py')
-        if binary_package and os.path.exists(init_script):
-            package_file.write(init_script, re.sub(package_dir_regex, '',
-                init_script))
-        package_file.close()
+        archiver = PackageArchiver(dirs_to_ignore, files_to_ignore,
+            self.settings.get('package_build_threads', 4))
+        try:
+            archiver.write(package_path, archiver.list_files(package_dir,
+                always_include))
+        except (OSError, IOError, zipfile.LargeZipFile) as (exception):
+            sublime.error_message(__name__ + ': An error occurred ' +
+                'creating the package file %s in %s. %s' % (package_filename,
+                package_destination, str(exception)))
+            return False
 
         return True
 
-    def install_package(self, package_name):
+    def is_vcs_package(self, package_name):
+        return self.get_vcs_upgrader(package_name)[0] != None
+
+    def get_vcs_upgrader(self, package_name):
+        package_dir = self.get_package_dir(package_name)
+        if os.path.exists(os.path.join(package_dir, '.git')):
+            return ('git', GitUpgrader(self.settings.get('git_binary'),
+                self.settings.get('git_update_command'), package_dir,
+                self.settings.get('cache_length')))
+        elif os.path.exists(os.path.join(package_dir, '.hg')):
+            return ('hg', HgUpgrader(self.settings.get('hg_binary'),
+                self.settings.get('hg_update_command'), package_dir,
+                self.settings.get('cache_length')))
+        return (None, None)
+
+    # Checks if there are incoming changes for the packages that are VCS
+    # working copies. The checks each run a VCS subprocess, and often a
+    # network request, so they are run concurrently on the task scheduler.
+    def list_vcs_incoming(self, package_names):
+        scheduler = self.get_scheduler()
+        checks = {}
+        for package_name in package_names:
+            vcs, upgrader = self.get_vcs_upgrader(package_name)
+            if not upgrader:
+                continue
+            checks[package_name] = (vcs, scheduler.submit(
+                upgrader.working_copy, upgrader.incoming))
+
+        incoming = {}
+        for package_name, (vcs, task) in checks.items():
+            incoming[package_name] = (vcs, task.wait())
+        return incoming
+
+    def download_package(self, package_name, packages):
+        url = packages[package_name]['downloads'][0]['url']
+        sha256 = packages[package_name]['downloads'][0].get('sha256')
+        package_path = os.path.join(sublime.installed_packages_path(),
+            package_name + '.sublime-package')
+
+        # The package is downloaded to a temp file and checked before it
+        # replaces any existing package file
+        tmp_package_path = package_path + '.download'
+        if not self.download_url_to_file(url, tmp_package_path,
+                'Error downloading package.', sha256):
+            return False
+        if not zipfile.is_zipfile(tmp_package_path):
+            os.remove(tmp_package_path)
+            sublime.error_message(__name__ + ': The package specified, ' +
+                '%s, could not be downloaded as a valid zip file.' %
+                (package_name,))
+            return False
+        if os.path.exists(package_path):
+            os.remove(package_path)
+        os.rename(tmp_package_path, package_path)
+        return package_path
+
+    # Installs or upgrades a list of packages, resolving the available
+    # packages only once. Archives are downloaded concurrently on the task
+    # scheduler, and each package is extracted as soon as its own download
+    # has completed, so a slow host only holds up its own packages. The
+    # results are returned in list order.
+    def install_packages(self, package_names):
         packages = self.list_available_packages()
+        scheduler = self.get_scheduler()
+
+        completed = Queue.Queue()
+        downloads = {}
+        for package_name in package_names:
+            if package_name not in packages or \
+                    self.is_vcs_package(package_name) or \
+                    package_name in downloads:
+                continue
+            url = packages[package_name]['downloads'][0]['url']
+            downloads[package_name] = scheduler.submit(self.get_domain(url),
+                functools.partial(self.download_package, package_name,
+                packages), functools.partial(lambda name, result:
+                    completed.put(name), package_name))
+
+        results = {}
+        for package_name in package_names:
+            if package_name not in downloads and package_name not in results:
+                results[package_name] = self.install_downloaded(package_name,
+                    packages, None)
+        for i in range(len(downloads)):
+            package_name = completed.get()
+            results[package_name] = self.install_downloaded(package_name,
+                packages, downloads[package_name])
+        return [results[package_name] for package_name in package_names]
+
+    def install_downloaded(self, package_name, packages, download):
+        info = {'name': package_name, 'download_time': 0}
+        package_path = None
+        if download:
+            package_path = download.result
+            info['download_time'] = download.duration
+            if not package_path:
+                info['result'] = False
+                info['install_time'] = 0
+                return info
+
+        start = time.time()
+        info['result'] = self.install_package(package_name, packages,
+            package_path)
+        info['install_time'] = time.time() - start
+        return info
+
+    def install_package(self, package_name, packages=None,
+            package_path=None):
+        if packages == None:
+            packages = self.list_available_packages()
 
         if package_name not in packages.keys():
             sublime.error_message(__name__ + ': The package specified,' +
                 ' %s, is not available.' % (package_name,))
             return False
 
-        download = packages[package_name]['downloads'][0]
-        url = download['url']
-
         package_filename = package_name + \
             '.sublime-package'
-        package_path = os.path.join(sublime.installed_packages_path(),
-            package_filename)
         pristine_package_path = os.path.join(os.path.dirname(
             sublime.packages_path()), 'Pristine Packages', package_filename)
 
@@ -987,67 +2365,37 @@ class PackageManager():
         package_metadata_file = os.path.join(package_dir,
             'package-metadata.json')
 
-        if os.path.exists(os.path.join(package_dir, '.git')):
-            return GitUpgrader(self.settings['git_binary'],
-                self.settings['git_update_command'], package_dir,
-                self.settings['cache_length']).run()
-        elif os.path.exists(os.path.join(package_dir, '.hg')):
-            return HgUpgrader(self.settings['hg_binary'],
-                self.settings['hg_update_command'], package_dir,
-                self.settings['cache_length']).run()
+        vcs, upgrader = self.get_vcs_upgrader(package_name)
+        if upgrader:
+            return upgrader.run()
 
         is_upgrade = os.path.exists(package_metadata_file)
         old_version = None
         if is_upgrade:
             old_version = self.get_metadata(package_name).get('version')
 
-        package_bytes = self.download_url(url, 'Error downloading package.')
-        if package_bytes == False:
-            return False
-        with open(package_path, "wb") as package_file:
-            package_file.write(package_bytes)
+        if not package_path:
+            package_path = self.download_package(package_name, packages)
+            if not package_path:
+                return False
 
-        if not os.path.exists(package_dir):
-            os.mkdir(package_dir)
+        # Everything is extracted to a dir next to the package dir, which
+        # only replaces the package dir once it is complete, so a failure
+        # part way through leaves the old version of the package in place
+        staging_dir = package_dir + '.installing'
 
-        # We create a backup copy incase something was edited
-        else:
-            try:
-                backup_dir = os.path.join(os.path.dirname(
-                    sublime.packages_path()), 'Backup',
-                    datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
-                if not os.path.exists(backup_dir):
-                    os.makedirs(backup_dir)
-                package_backup_dir = os.path.join(backup_dir, package_name)
-                shutil.copytree(package_dir, package_backup_dir)
-            except (OSError, IOError) as (exception):
-                sublime.error_message(__name__ + ': An error occurred while' +
-                    ' trying to backup the package directory for %s. %s' %
-                    (package_name, str(exception)))
-                shutil.rmtree(package_backup_dir)
-                return False
+        # The archive is fully checked before anything in the package
+        # directory is touched, so a bad archive leaves the old version
+        # of the package in place
+        package_zip = zipfile.ZipFile(package_path, 'r')
 
-        # Here we clean out the directory to preven issues with old files
-        # however don't just recursively delete the whole package dir since
-        # that will fail on Windows if a user has explorer open to it
-        def slow_delete(function, path, excinfo):
-            if function == os.remove:
-                time.sleep(0.2)
-                os.remove(path)
-        try:
-            for path in os.listdir(package_dir):
-                full_path = os.path.join(package_dir, path)
-                if os.path.isdir(full_path):
-                    shutil.rmtree(full_path, onerror=slow_delete)
-                else:
-                    os.remove(full_path)
-        except (OSError, IOError) as (exception):
-            sublime.error_message(__name__ + ': An error occurred while' +
-                ' trying to remove the package directory for %s. %s' %
-                (package_name, str(exception)))
+        def fail():
+            package_zip.close()
+            if os.path.exists(package_path):
+                os.remove(package_path)
+            self.remove_dir(staging_dir)
             return False
 
-        package_zip = zipfile.ZipFile(package_path, 'r')
         root_level_paths = []
         last_path = None
         for path in package_zip.namelist():
@@ -1055,19 +2403,30 @@ class PackageManager():
             if path.find('/') in [len(path)-1, -1]:
                 root_level_paths.append(path)
             if path[0] == '/' or path.find('..') != -1:
-                sublime.error_message(__name__ + ': The package ' +
+                sublime.error_message((__name__ + ': The package ' +
                     'specified, %s, contains files outside of the package ' +
-                    'dir and cannot be safely installed.' % (package_name,))
-                return False
+                    'dir and cannot be safely installed.') % (package_name,))
+                return fail()
 
         if last_path and len(root_level_paths) == 0:
             root_level_paths.append(last_path[0:last_path.find('/')+1])
 
-        os.chdir(package_dir)
+        # We create a backup copy incase something was edited
+        if os.path.exists(package_dir):
+            try:
+                backup_store = self.get_backup_store()
+                backup_store.snapshot(package_name, package_dir)
+                backup_store.prune(self.settings.get('backup_retention', 5))
+            except (OSError, IOError) as (exception):
+                sublime.error_message(__name__ + ': An error occurred while' +
+                    ' trying to backup the package directory for %s. %s' %
+                    (package_name, str(exception)))
+                return fail()
 
         # Here we don’t use .extractall() since it was having issues on OS X
         skip_root_dir = len(root_level_paths) == 1 and \
             root_level_paths[0].endswith('/')
+        members = []
         for path in package_zip.namelist():
             dest = path
             if os.name == 'nt':
@@ -1084,31 +2443,105 @@ class PackageManager():
             # that folder name from the paths as we extract entries
             if skip_root_dir:
                 dest = dest[len(root_level_paths[0]):]
-            dest = os.path.join(package_dir, dest)
-            if path.endswith('/'):
-                if not os.path.exists(dest):
-                    os.makedirs(dest)
-            else:
-                dest_dir = os.path.dirname(dest)
+            if not dest:
+                continue
+            members.append((path, dest))
+
+        manifest_file = os.path.join(package_dir, 'package-control.manifest')
+        old_manifest = None
+        if self.settings.get('delta_upgrades') and \
+                os.path.exists(manifest_file):
+            try:
+                with open(manifest_file) as f:
+                    old_manifest = json.load(f)
+            except (IOError, ValueError):
+                old_manifest = None
+
+        try:
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+            os.mkdir(staging_dir)
+        except (OSError, IOError) as (exception):
+            sublime.error_message(__name__ + ': An error occurred while' +
+                ' trying to create a directory to install %s into. %s' %
+                (package_name, str(exception)))
+            return fail()
+
+        extract_span = _tracer.span('extract', package_name)
+        extracted_files = 0
+        extracted_bytes = 0
+        manifest = {}
+        unchanged = set()
+        try:
+            for path, dest in members:
+                full_dest = os.path.join(staging_dir, dest)
+                if path.endswith('/'):
+                    if not os.path.exists(full_dest):
+                        os.makedirs(full_dest)
+                    continue
+
+                # A delta upgrade only writes the files that changed, and
+                # brings the rest over from the current package dir
+                info = package_zip.getinfo(path)
+                old_path = os.path.join(package_dir, dest)
+                if old_manifest != None and self.is_unchanged(old_path,
+                        old_manifest.get(dest), info):
+                    self.carry_over(old_path, full_dest)
+                    manifest[dest] = [info.CRC, info.file_size,
+                        os.path.getmtime(full_dest)]
+                    unchanged.add(dest)
+                    continue
+
+                dest_dir = os.path.dirname(full_dest)
                 if not os.path.exists(dest_dir):
                     os.makedirs(dest_dir)
                 try:
-                    open(dest, 'wb').write(package_zip.read(path))
-                except (IOError, UnicodeDecodeError):
+                    # Members are copied in chunks so that large files in
+                    # the package do not have to fit in memory
+                    source = package_zip.open(path)
+                    with open(full_dest, 'wb') as dest_file:
+                        shutil.copyfileobj(source, dest_file, 65536)
+                    source.close()
+                    manifest[dest] = [info.CRC, info.file_size,
+                        os.path.getmtime(full_dest)]
+                    extracted_files += 1
+                    extracted_bytes += info.file_size
+                except (IOError, OSError, UnicodeDecodeError):
                     print ('%s: Skipping file from package ' +
                         'named %s due to an invalid filename') % (__name__,
                         path)
+
+            if old_manifest != None:
+                self.carry_over_extra_files(package_dir, staging_dir,
+                    old_manifest, manifest, unchanged)
+
+            with open(os.path.join(staging_dir, 'package-control.manifest'),
+                    'w') as f:
+                json.dump(manifest, f)
+
+            with open(os.path.join(staging_dir, 'package-metadata.json'),
+                    'w') as f:
+                metadata = {
+                    "version": packages[package_name]['downloads'][0]['version'],
+                    "url": packages[package_name]['url'],
+                    "description": packages[package_name]['description']
+                }
+                json.dump(metadata, f)
+        except (OSError, IOError) as (exception):
+            sublime.error_message(__name__ + ': An error occurred while' +
+                ' trying to extract %s. %s' % (package_name, str(exception)))
+            return fail()
         package_zip.close()
+        extract_span.finish(files=extracted_files, bytes=extracted_bytes,
+            unchanged=len(manifest) - extracted_files)
+
+        if not self.swap_dirs(package_name, staging_dir, package_dir):
+            return fail()
 
         self.print_messages(package_name, package_dir, is_upgrade, old_version)
 
-        with open(package_metadata_file, 'w') as f:
-            metadata = {
-                "version": packages[package_name]['downloads'][0]['version'],
-                "url": packages[package_name]['url'],
-                "description": packages[package_name]['description']
-            }
-            json.dump(metadata, f)
+        _directory_snapshot.invalidate()
+        _package_catalog.clear_metadata(package_name)
 
         # Here we delete the package file from the installed packages directory
         # since we don't want to accidentally overwrite user changes
@@ -1118,9 +2551,125 @@ class PackageManager():
         if os.path.exists(pristine_package_path):
             os.remove(pristine_package_path)
 
-        os.chdir(sublime.packages_path())
         return True
 
+    # Hard links make keeping an unchanged file free where they are
+    # available. Either way the staged file is a new directory entry, so
+    # removing the old package dir does not affect it.
+    def carry_over(self, source, dest):
+        dest_dir = os.path.dirname(dest)
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        if hasattr(os, 'link'):
+            try:
+                os.link(source, dest)
+                return
+            except (OSError):
+                pass
+        shutil.copy2(source, dest)
+
+    # A delta upgrade keeps files that were not installed from the package,
+    # such as ones the user added, while files that were dropped from the
+    # package are left behind. Compiled python files are not in the
+    # manifest, and are only kept along with the source they were compiled
+    # from, otherwise a module that was removed from the package could still
+    # be imported from its stale bytecode.
+    def carry_over_extra_files(self, package_dir, staging_dir, old_manifest,
+            manifest, unchanged):
+        for root, dirs, files in os.walk(package_dir):
+            for file in files:
+                full_path = os.path.join(root, file)
+                dest = os.path.relpath(full_path, package_dir).replace(
+                    os.sep, '/')
+                if dest in old_manifest or dest in manifest or dest in [
+                        'package-control.manifest', 'package-metadata.json']:
+                    continue
+                base, ext = os.path.splitext(dest)
+                if ext in ['.pyc', '.pyo']:
+                    source = base + '.py'
+                    from_package = source in old_manifest or \
+                        source in manifest
+                    if source not in unchanged and (from_package or
+                            not os.path.exists(os.path.join(package_dir,
+                                source))):
+                        continue
+                full_dest = os.path.join(staging_dir, dest)
+                if not os.path.exists(full_dest):
+                    self.carry_over(full_path, full_dest)
+
+    # Puts the staged package dir in place of the current one. The renames
+    # are the only steps that touch the live package, and the old dir is
+    # only deleted once the new one is in place.
+    def swap_dirs(self, package_name, staging_dir, package_dir):
+        old_dir = package_dir + '.old'
+        try:
+            self.remove_dir(old_dir)
+            if os.path.exists(package_dir):
+                try:
+                    os.rename(package_dir, old_dir)
+                except (OSError):
+                    # Windows will not rename a dir while a file in it is
+                    # open, which is usual for a loaded plugin
+                    self.replace_contents(staging_dir, package_dir)
+                    return True
+            os.rename(staging_dir, package_dir)
+        except (OSError, IOError) as (exception):
+            if not os.path.exists(package_dir) and os.path.exists(old_dir):
+                os.rename(old_dir, package_dir)
+            sublime.error_message(__name__ + ': An error occurred while' +
+                ' trying to replace the package directory for %s. %s' %
+                (package_name, str(exception)))
+            return False
+        self.remove_dir(old_dir)
+        return True
+
+    # Clears out the package dir and moves the staged files into it. Unlike
+    # swap_dirs this can leave a partly installed package if it fails, but
+    # only needs the files themselves to be removable.
+    def replace_contents(self, staging_dir, package_dir):
+        def slow_delete(function, path, excinfo):
+            if function == os.remove:
+                time.sleep(0.2)
+                os.remove(path)
+        for path in os.listdir(package_dir):
+            full_path = os.path.join(package_dir, path)
+            if os.path.isdir(full_path):
+                shutil.rmtree(full_path, onerror=slow_delete)
+            else:
+                os.remove(full_path)
+        for path in os.listdir(staging_dir):
+            os.rename(os.path.join(staging_dir, path),
+                os.path.join(package_dir, path))
+        os.rmdir(staging_dir)
+
+    def remove_dir(self, dir):
+        # Don't just recursively delete the dir since that will fail on
+        # Windows if a user has explorer open
+        def slow_delete(function, path, excinfo):
+            if function == os.remove:
+                time.sleep(0.2)
+                os.remove(path)
+        if not os.path.exists(dir):
+            return
+        try:
+            shutil.rmtree(dir, onerror=slow_delete)
+        except (OSError, IOError):
+            # PackageCleanup removes it on the next start
+            open(os.path.join(dir, 'package-control.cleanup'), 'w').close()
+            _directory_snapshot.invalidate()
+
+    # The manifest records the CRC and size from the archive along with the
+    # mtime of the file once written, so files the user has edited since
+    # are always rewritten
+    def is_unchanged(self, full_path, manifest_entry, info):
+        if not manifest_entry or not os.path.isfile(full_path):
+            return False
+        crc, size, mtime = manifest_entry
+        if crc != info.CRC or size != info.file_size:
+            return False
+        stat = os.stat(full_path)
+        return stat.st_size == size and stat.st_mtime == mtime
+
     def print_messages(self, package, package_dir, is_upgrade, old_version):
         messages_file = os.path.join(package_dir, 'messages.json')
         if os.path.exists(messages_file):
@@ -1139,13 +2688,8 @@ class PackageManager():
                 shown = True
 
             elif is_upgrade and old_version:
-                upgrade_messages = list(set(message_info.keys()) -
-                    set(['install']))
-                upgrade_messages = sorted(upgrade_messages,
-                    cmp=self.compare_versions, reverse=True)
-                for version in upgrade_messages:
-                    if self.compare_versions(old_version, version) >= 0:
-                        break
+                for version in self.list_messages_since(message_info,
+                        old_version):
                     if not shown:
                         message = '\n\n' + package + ':'
                         self.printer.write(message)
@@ -1229,6 +2773,8 @@ class PackageManager():
         if can_delete_dir:
             os.rmdir(package_dir)
 
+        _directory_snapshot.invalidate()
+        _package_catalog.clear_metadata(package_name)
         return True
 
 
@@ -1292,23 +2838,35 @@ class PackageInstaller():
         self.manager = PackageManager()
 
     def make_package_list(self, ignore_actions=[], override_action=None,
-            ignore_packages=[]):
+            ignore_packages=[], package_names=None):
         packages = self.manager.list_available_packages()
-        installed_packages = self.manager.list_packages()
+        installed_packages = set(self.manager.list_packages())
+
+        if package_names == None:
+            package_names = _package_catalog.sorted_names
+
+        vcs_incoming = {}
+        if not override_action:
+            vcs_incoming = self.manager.list_vcs_incoming([package for
+                package in package_names if package in installed_packages])
 
         package_list = []
-        for package in sorted(packages.iterkeys()):
+        for package in package_names:
             if ignore_packages and package in ignore_packages:
                 continue
+            if package not in packages:
+                continue
             package_entry = [package]
             info = packages[package]
             download = info['downloads'][0]
 
             if package in installed_packages:
                 installed = True
-                metadata = self.manager.get_metadata(package)
+                metadata = _package_catalog.get_metadata(self.manager,
+                    package)
                 if metadata.get('version'):
                     installed_version = metadata['version']
+                    installed_version_key = metadata['version_key']
                 else:
                     installed_version = None
             else:
@@ -1318,27 +2876,12 @@ class PackageInstaller():
                 installed and installed_version else 'unknown version'
             new_version = 'v' + download['version']
 
-            vcs = None
-            package_dir = self.manager.get_package_dir(package)
-            settings = self.manager.settings
-
             if override_action:
                 action = override_action
                 extra = ''
 
             else:
-                if os.path.exists(os.path.join(sublime.packages_path(),
-                        package, '.git')):
-                    vcs = 'git'
-                    incoming = GitUpgrader(settings.get('git_binary'),
-                        settings.get('git_update_command'), package_dir,
-                        settings.get('cache_length')).incoming()
-                elif os.path.exists(os.path.join(sublime.packages_path(),
-                        package, '.hg')):
-                    vcs = 'hg'
-                    incoming = HgUpgrader(settings.get('hg_binary'),
-                        settings.get('hg_update_command'), package_dir,
-                        settings.get('cache_length')).incoming()
+                vcs, incoming = vcs_incoming.get(package, (None, None))
 
                 if installed:
                     if not installed_version:
@@ -1354,8 +2897,8 @@ class PackageInstaller():
                             extra = ' %s with %s' % (installed_version_name,
                                 new_version)
                     else:
-                        res = self.manager.compare_versions(
-                            installed_version, download['version'])
+                        res = cmp(installed_version_key,
+                            _package_catalog.get_version_key(package))
                         if res < 0:
                             action = 'upgrade'
                             extra = ' to %s from %s' % (new_version,
@@ -1402,6 +2945,23 @@ class PackageInstallerThread(threading.Thread):
         self.result = self.manager.install_package(self.package)
 
 
+class PackagesInstallerThread(threading.Thread):
+    def __init__(self, manager, packages):
+        self.packages = packages
+        self.manager = manager
+        threading.Thread.__init__(self)
+
+    def run(self):
+        self.result = True
+        for info in self.manager.install_packages(self.packages):
+            if not info['result']:
+                self.result = False
+                continue
+            print (__name__ + ': Upgraded %s (download %.2fs, install ' +
+                '%.2fs)') % (info['name'], info['download_time'],
+                info['install_time'])
+
+
 class InstallPackageCommand(sublime_plugin.WindowCommand):
     def run(self):
         thread = InstallPackageThread(self.window)
@@ -1428,6 +2988,39 @@ class InstallPackageThread(threading.Thread, PackageInstaller):
         sublime.set_timeout(show_quick_panel, 10)
 
 
+class SearchPackagesCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        self.window.show_input_panel('Search Packages', '', self.on_done,
+            None, None)
+
+    def on_done(self, query):
+        thread = SearchPackagesThread(self.window, query)
+        thread.start()
+        ThreadProgress(thread, 'Searching packages', '')
+
+
+class SearchPackagesThread(threading.Thread, PackageInstaller):
+    def __init__(self, window, query):
+        self.window = window
+        self.query = query
+        self.completion_type = 'installed'
+        threading.Thread.__init__(self)
+        PackageInstaller.__init__(self)
+
+    def run(self):
+        # Loading the packages makes sure the catalog is up to date
+        self.manager.list_available_packages()
+        self.package_list = self.make_package_list(['none'],
+            package_names=_package_catalog.search(self.query))
+        def show_quick_panel():
+            if not self.package_list:
+                sublime.error_message(__name__ + ': There are no packages ' +
+                    'matching %s.' % self.query)
+                return
+            self.window.show_quick_panel(self.package_list, self.on_done)
+        sublime.set_timeout(show_quick_panel, 10)
+
+
 class DiscoverPackagesCommand(sublime_plugin.WindowCommand):
     def run(self):
         thread = DiscoverPackagesThread(self.window)
@@ -1513,11 +3106,17 @@ class UpgradeAllPackagesThread(threading.Thread, PackageInstaller):
         PackageInstaller.__init__(self)
 
     def run(self):
-        for info in self.make_package_list(['install', 'reinstall', 'none']):
-            thread = PackageInstallerThread(self.manager, info[0])
-            thread.start()
-            ThreadProgress(thread, 'Upgrading package %s' % info[0],
-                'Package %s successfully %s' % (info[0], self.completion_type))
+        package_names = [info[0] for info in self.make_package_list([
+            'install', 'reinstall', 'none'])]
+        if not package_names:
+            sublime.set_timeout(lambda: sublime.status_message(
+                'No packages ready for upgrade'), 10)
+            return
+        thread = PackagesInstallerThread(self.manager, package_names)
+        thread.start()
+        ThreadProgress(thread, 'Upgrading %s packages' % len(package_names),
+            '%s packages successfully %s' % (len(package_names),
+            self.completion_type))
 
 
 class ExistingPackagesCommand():
@@ -1645,6 +3244,145 @@ class RemovePackageThread(threading.Thread):
         sublime.set_timeout(unignore_package, 10)
 
 
+class BackupsCommand():
+    def make_backup_list(self):
+        self.manager = PackageManager()
+        self.backups = self.manager.get_backup_store().list_snapshots()
+        backup_list = []
+        for backup in self.backups:
+            backup_time = datetime.datetime.strptime(backup['time'],
+                '%Y%m%d%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
+            backup_list.append([backup['package'], '%s; %s files' % (
+                backup_time, len(backup['files']))])
+        return backup_list
+
+
+class ListBackupsCommand(sublime_plugin.WindowCommand, BackupsCommand):
+    def run(self):
+        self.backup_list = self.make_backup_list()
+        if not self.backup_list:
+            sublime.error_message(__name__ + ': There are no package ' +
+                'backups to list.')
+            return
+        self.window.show_quick_panel(self.backup_list, self.on_done)
+
+    def on_done(self, picked):
+        if picked == -1:
+            return
+        backup = self.backups[picked]
+        message = '\n\nBackup of %s from %s:\n  ' % (backup['package'],
+            self.backup_list[picked][1].split(';')[0])
+        message += '\n  '.join(sorted(backup['files'].keys()))
+        self.manager.printer.write(message)
+        self.manager.printer.show()
+
+
+class RestoreBackupCommand(sublime_plugin.WindowCommand, BackupsCommand):
+    def run(self):
+        self.backup_list = self.make_backup_list()
+        if not self.backup_list:
+            sublime.error_message(__name__ + ': There are no package ' +
+                'backups to restore.')
+            return
+        self.window.show_quick_panel(self.backup_list, self.on_done)
+
+    def on_done(self, picked):
+        if picked == -1:
+            return
+        backup = self.backups[picked]
+        thread = RestoreBackupThread(self.manager, backup['name'],
+            backup['package'])
+        thread.start()
+        ThreadProgress(thread, 'Restoring package %s' % backup['package'],
+            'Package %s successfully restored' % backup['package'])
+
+
+class RestoreBackupThread(threading.Thread):
+    def __init__(self, manager, backup, package):
+        self.manager = manager
+        self.backup = backup
+        self.package = package
+        threading.Thread.__init__(self)
+
+    def run(self):
+        try:
+            self.manager.get_backup_store().restore(self.backup,
+                self.manager.get_package_dir(self.package))
+            # The restored package-metadata.json has an older version
+            _directory_snapshot.invalidate()
+            _package_catalog.clear_metadata(self.package)
+            self.result = True
+        except (OSError, IOError) as (exception):
+            sublime.set_timeout(lambda: sublime.error_message(__name__ +
+                ': An error occurred while trying to restore the backup ' +
+                'of %s. %s' % (self.package, str(exception))), 10)
+            self.result = False
+
+
+class PerformanceReportCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        spans = _tracer.get_spans()
+        if not spans:
+            sublime.error_message(__name__ + ': No operations have been ' +
+                'recorded yet.')
+            return
+
+        view = self.window.new_file()
+        view.set_name(__name__ + ' Performance Report')
+        view.set_scratch(True)
+        edit = view.begin_edit()
+        view.insert(edit, 0, self.build_report(spans))
+        view.end_edit(edit)
+        view.set_read_only(True)
+        _tracer.export()
+
+    def percentile(self, durations, percent):
+        index = int(len(durations) * percent / 100.0)
+        return durations[min(index, len(durations) - 1)]
+
+    def build_report(self, spans):
+        lines = [__name__ + ' Performance Report', '',
+            '%-10s %6s %10s %9s %9s %9s %12s' % ('Operation', 'Count',
+            'Total s', 'p50 ms', 'p90 ms', 'Max ms', 'Bytes')]
+
+        kinds = {}
+        for span in spans:
+            kinds.setdefault(span['kind'], []).append(span)
+        for kind in sorted(kinds.keys()):
+            if kind == 'cache':
+                continue
+            durations = sorted([span['duration'] for span in kinds[kind]])
+            num_bytes = sum([span.get('bytes', 0) for span in kinds[kind]])
+            lines.append('%-10s %6d %10.2f %9.1f %9.1f %9.1f %12d' % (kind,
+                len(durations), sum(durations),
+                self.percentile(durations, 50) * 1000,
+                self.percentile(durations, 90) * 1000,
+                durations[-1] * 1000, num_bytes))
+
+        lookups = kinds.get('cache', [])
+        if lookups:
+            hits = len([span for span in lookups if span['hit']])
+            stale = len([span for span in lookups if span['stale']])
+            lines.extend(['', 'Cache lookups: %d, hits: %d, stale hits: %d'
+                % (len(lookups), hits, stale)])
+
+        errors = [span for span in spans if span.get('error') or
+            span.get('result') == 'error']
+        if errors:
+            lines.extend(['', 'Errors:'])
+            for span in errors:
+                lines.append('  %-10s %s %s' % (span['kind'], span['name'],
+                    span.get('error', '')))
+
+        lines.extend(['', 'Slowest operations:'])
+        slowest = sorted([span for span in spans if span['kind'] != 'cache'],
+            key=lambda span: span['duration'], reverse=True)
+        for span in slowest[0:20]:
+            lines.append('  %9.1f ms  %-10s %s' % (span['duration'] * 1000,
+                span['kind'], span['name']))
+        return '\n'.join(lines) + '\n'
+
+
 class AddRepositoryChannelCommand(sublime_plugin.WindowCommand):
     def run(self):
         self.window.show_input_panel('Repository Channel JSON URL', '',
@@ -1789,13 +3527,103 @@ class AutomaticUpgrader(threading.Thread):
                 return
 
             print __name__ + ': Installing %s upgrades' % len(packages)
-            for package in packages:
-                self.installer.manager.install_package(package[0])
+            results = self.installer.manager.install_packages(
+                [package[0] for package in packages])
+            for package, info in zip(packages, results):
+                if not info['result']:
+                    continue
                 version = re.sub('^.*?(v[\d\.]+).*?$', '\\1', package[2])
                 if version == package[2] and version.find('pull with') != -1:
                     vcs = re.sub('^pull with (\w+).*?$', '\\1', version)
                     version = 'latest %s commit' % vcs
-                print __name__ + ': Upgraded %s to %s' % (package[0], version)
+                print (__name__ + ': Upgraded %s to %s (download %.2fs, ' +
+                    'install %.2fs)') % (package[0], version,
+                    info['download_time'], info['install_time'])
+
+
+class BackgroundRefresher(threading.Thread):
+    # Keeps the channel, repository and VCS incoming caches warm so that
+    # commands find the info they need already cached. Refreshes run just
+    # after the cache expires, with some jitter so clients started at the
+    # same time do not all hit the servers at once, and are skipped once
+    # the hourly budget for downloaded bytes has been used up.
+    instance = None
+
+    @classmethod
+    def start_if_enabled(cls):
+        settings = sublime.load_settings(__name__ + '.sublime-settings')
+        if not settings.get('background_refresh') or cls.instance:
+            return
+        cls.instance = BackgroundRefresher()
+        cls.instance.start()
+
+    @classmethod
+    def stop_running(cls):
+        if cls.instance:
+            cls.instance.stopped.set()
+            cls.instance = None
+
+    def __init__(self):
+        self.manager = PackageManager()
+        self.stopped = threading.Event()
+        self.transfers = []
+        self.last_transfer_total = _transfer_counter.total
+        self.last_vcs_check = 0
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+    def load_manager(self, loaded):
+        self.manager = PackageManager()
+        loaded.set()
+
+    def reload_settings(self):
+        # Settings can only be read from the main thread, so a new
+        # PackageManager is created there to pick up any changes
+        loaded = threading.Event()
+        sublime.set_timeout(functools.partial(self.load_manager, loaded), 10)
+        loaded.wait(10)
+
+    def used_budget(self):
+        # Refreshes started by the previous run may have finished after it
+        # returned, so the bytes are counted when the next run starts
+        total = _transfer_counter.total
+        self.transfers.append((time.time(), total - self.last_transfer_total))
+        self.last_transfer_total = total
+
+        hour_ago = time.time() - 3600
+        self.transfers = [transfer for transfer in self.transfers if
+            transfer[0] > hour_ago]
+        return sum([transfer[1] for transfer in self.transfers])
+
+    def refresh(self):
+        settings = self.manager.settings
+        budget = settings.get('background_refresh_budget', 1024) * 1024
+        if budget and self.used_budget() >= budget:
+            print (__name__ + ': Skipping background refresh, the budget ' +
+                'of %sKB per hour has been used') % (budget / 1024)
+            return
+
+        self.manager.list_available_packages()
+
+        frequency = settings.get('auto_upgrade_frequency', 12) * 60 * 60
+        if time.time() - self.last_vcs_check >= frequency:
+            self.last_vcs_check = time.time()
+            self.manager.list_vcs_incoming(self.manager.list_packages())
+
+    def run(self):
+        # Startup is left to the automatic upgrader, which already fetches
+        # the channels and repositories
+        self.stopped.wait(random.uniform(60, 120))
+        while not self.stopped.isSet():
+            self.reload_settings()
+            try:
+                self.refresh()
+            except (Exception):
+                print '%s: Error refreshing in the background\n%s' % (
+                    __name__, traceback.format_exc())
+            cache_length = max(60, self.manager.settings.get('cache_length',
+                300))
+            self.stopped.wait(cache_length * random.uniform(1.0, 1.2))
 
 
 class PackageCleanup(threading.Thread):
@@ -1803,14 +3631,21 @@ class PackageCleanup(threading.Thread):
         threading.Thread.__init__(self)
 
     def run(self):
-        for path in os.listdir(sublime.packages_path()):
+        listing = _directory_snapshot.get(sublime.packages_path())
+        for path in listing['cleanup']:
             package_dir = os.path.join(sublime.packages_path(), path)
-            if os.path.exists(os.path.join(package_dir,
-                    'package-control.cleanup')):
-                shutil.rmtree(package_dir)
-                print __name__ + ': Removed old directory for package %s' % \
-                    path
+            shutil.rmtree(package_dir)
+            print __name__ + ': Removed old directory for package %s' % \
+                path
+        if listing['cleanup']:
+            _directory_snapshot.invalidate(sublime.packages_path())
         sublime.set_timeout(lambda: AutomaticUpgrader().start(), 10)
+        sublime.set_timeout(BackgroundRefresher.start_if_enabled, 20)
+
+
+def unload_handler():
+    BackgroundRefresher.stop_running()
+    _tracer.export()
 
 
 PackageCleanup().start()
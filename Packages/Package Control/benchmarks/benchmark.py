@@ -0,0 +1,477 @@
+# Benchmarks for Package Control that run outside of Sublime Text
+#
+# A local HTTP server serves a synthetic channel, a configurable number of
+# repositories and a zip file for every package. The sublime and
+# sublime_plugin modules are replaced with stubs, and Package Control.py is
+# loaded into a temporary Packages dir so nothing on the machine is touched.
+#
+# Usage: python benchmark.py [--repositories 20] [--packages 50]
+#     [--zip-size 65536] [--zip-files 20] [--iterations 10] [--latency 0]
+#
+# Latency percentiles are reported for each operation, along with the peak
+# number of threads that were alive while it ran, the number of HTTP
+# requests made and how many of those were answered 304 Not Modified. Each operation runs in a process of its own, since the
+# peak resident memory of a process only ever goes up. The peak of that
+# process is reported, along with how much of it came from the operation
+# rather than from loading Package Control and setting up.
+import sys
+import os
+import imp
+import json
+import time
+import hashlib
+import email.utils
+import shutil
+import random
+import tempfile
+import threading
+import zipfile
+import StringIO
+import optparse
+import subprocess
+import BaseHTTPServer
+import SocketServer
+
+try:
+    import resource
+except (ImportError):
+    resource = None
+
+
+package_control_dir = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__)))
+
+
+class SublimeStub():
+    # Provides the parts of the sublime API that Package Control uses
+    # when it is not running inside of Sublime Text
+    def __init__(self, data_dir, settings):
+        self.data_dir = data_dir
+        self.settings = settings
+        for dir in ['Packages', os.path.join('Packages', 'User'),
+                'Installed Packages', 'Pristine Packages']:
+            os.makedirs(os.path.join(data_dir, dir))
+
+    def install(self):
+        sublime = imp.new_module('sublime')
+        sublime.packages_path = lambda: os.path.join(self.data_dir,
+            'Packages')
+        sublime.installed_packages_path = lambda: os.path.join(
+            self.data_dir, 'Installed Packages')
+        sublime.load_settings = lambda name: StubSettings(self.settings)
+        sublime.save_settings = lambda name: None
+        # Callbacks are meant for the UI thread, which does not exist here.
+        # This also keeps the automatic upgrader from starting.
+        sublime.set_timeout = lambda callback, delay: None
+        sublime.error_message = self.error_message
+        sublime.status_message = lambda message: None
+        sublime.message_dialog = lambda message: None
+        sublime.active_window = lambda: None
+        sublime.platform = lambda: 'linux'
+        sublime.arch = lambda: 'x64'
+        sublime.MONOSPACE_FONT = 1
+        sys.modules['sublime'] = sublime
+
+        sublime_plugin = imp.new_module('sublime_plugin')
+        for name in ['WindowCommand', 'TextCommand', 'ApplicationCommand',
+                'EventListener']:
+            setattr(sublime_plugin, name, type(name, (object,), {}))
+        sys.modules['sublime_plugin'] = sublime_plugin
+
+    def error_message(self, message):
+        print 'Error: ' + message
+
+
+class StubSettings():
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def set(self, name, value):
+        self.values[name] = value
+
+
+def load_default_settings():
+    # The settings file allows // comments, which json does not
+    path = os.path.join(package_control_dir,
+        'Package Control.sublime-settings')
+    with open(path) as f:
+        lines = [line for line in f.read().splitlines() if not
+            line.strip().startswith('//')]
+    return json.loads('\n'.join(lines))
+
+
+class FakeServer():
+    # Serves a channel at /channel.json that lists every repository, the
+    # repositories at /repository-N.json and a zip at /packages/NAME.zip
+    # for every package. All packages share the same zip contents. Nothing
+    # ever changes, so conditional requests are always answered with 304.
+    def __init__(self, repositories, packages, zip_size, zip_files, latency):
+        self.repositories = repositories
+        self.packages = packages
+        self.latency = latency
+        self.requests = 0
+        self.not_modified = 0
+        self.last_modified = email.utils.formatdate(time.time() - 60,
+            usegmt=True)
+        self.lock = threading.Lock()
+        self.zip_data = self.build_zip(zip_size, zip_files)
+        self.base_url = None
+
+    def build_zip(self, zip_size, zip_files):
+        output = StringIO.StringIO()
+        package_zip = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+        file_size = max(1, zip_size / max(1, zip_files))
+        rand = random.Random(0)
+        for i in range(zip_files):
+            # Half random and half repeated data gives a compression ratio
+            # that is close to a typical package
+            data = ''.join([chr(rand.randint(32, 126)) for j in
+                range(file_size / 2)])
+            data += 'x' * (file_size - len(data))
+            package_zip.writestr('package-master/file-%d.py' % i, data)
+        package_zip.close()
+        return output.getvalue()
+
+    def package_name(self, repository, package):
+        return 'Package %03d-%03d' % (repository, package)
+
+    def channel(self):
+        return {
+            'schema_version': '1.0',
+            'repositories': [self.base_url + '/repository-%d.json' % i for
+                i in range(self.repositories)],
+            'package_name_map': {}
+        }
+
+    def repository(self, repository):
+        packages = []
+        for i in range(self.packages):
+            name = self.package_name(repository, i)
+            packages.append({
+                'name': name,
+                'description': 'Synthetic package %s for benchmarks' % name,
+                'author': 'Benchmark',
+                'homepage': self.base_url + '/',
+                'platforms': {
+                    '*': [{
+                        'version': '1.0.%d' % i,
+                        'url': self.base_url + '/packages/' +
+                            name.replace(' ', '%20') + '.zip'
+                    }]
+                }
+            })
+        return {'schema_version': '1.0', 'packages': packages}
+
+    def respond(self, path):
+        if path == '/channel.json':
+            return json.dumps(self.channel())
+        if path.startswith('/repository-') and path.endswith('.json'):
+            try:
+                repository = int(path[12:-5])
+            except (ValueError):
+                return None
+            if repository < self.repositories:
+                return json.dumps(self.repository(repository))
+        if path.startswith('/packages/') and path.endswith('.zip'):
+            return self.zip_data
+        return None
+
+    def get_etag(self, body):
+        return '"%s"' % hashlib.md5(body).hexdigest()
+
+    def is_not_modified(self, headers, etag):
+        if headers.get('If-None-Match'):
+            etags = [tag.strip() for tag in
+                headers['If-None-Match'].split(',')]
+            return etag in etags or '*' in etags
+        if headers.get('If-Modified-Since'):
+            since = email.utils.parsedate_tz(headers['If-Modified-Since'])
+            if not since:
+                return False
+            return email.utils.mktime_tz(since) >= email.utils.mktime_tz(
+                email.utils.parsedate_tz(self.last_modified))
+        return False
+
+    def start(self):
+        fake_server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with fake_server.lock:
+                    fake_server.requests += 1
+                if fake_server.latency:
+                    time.sleep(fake_server.latency)
+                body = fake_server.respond(self.path)
+                if body == None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                etag = fake_server.get_etag(body)
+                if fake_server.is_not_modified(self.headers, etag):
+                    with fake_server.lock:
+                        fake_server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Last-Modified',
+                        fake_server.last_modified)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', fake_server.last_modified)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ThreadSampler(threading.Thread):
+    # Records the largest number of threads that were alive at once
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.isSet():
+            # The sampler itself is not counted
+            self.peak = max(self.peak, threading.activeCount() - 1)
+            self.stopped.wait(0.005)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def peak_memory():
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, while OS X reports bytes
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+
+def percentile(samples, percent):
+    samples = sorted(samples)
+    index = int(round(percent / 100.0 * len(samples) + 0.5)) - 1
+    return samples[max(0, min(len(samples) - 1, index))]
+
+
+class Benchmark():
+    # The operations are measured in this order. Each one is prepared by
+    # doing whatever the operations before it would have left behind. The
+    # revalidate ones expire the cached info first, and include the
+    # background refresh that then checks it with the server.
+    operations = ['list_repositories (cold)', 'list_repositories (warm)',
+        'list_repositories (revalidate)', 'list_available_packages (cold)',
+        'list_available_packages (warm)',
+        'list_available_packages (revalidate)', 'make_package_list (warm)',
+        'install_package (new)', 'install_package (upgrade)']
+
+    def __init__(self, module, server, iterations):
+        self.module = module
+        self.server = server
+        self.iterations = iterations
+
+    def clear_caches(self):
+        cache = self.module._channel_repository_cache
+        cache.clear()
+        if os.path.exists(cache.get_cache_dir()):
+            shutil.rmtree(cache.get_cache_dir())
+
+    def expire_caches(self):
+        for entry in self.module._channel_repository_cache.values():
+            entry['time'] = 0
+
+    def revalidate(self, function):
+        function()
+        while self.module._background_refreshes:
+            time.sleep(0.001)
+
+    def measure(self, name, function, setup=None):
+        timings = []
+        requests = self.server.requests
+        not_modified = self.server.not_modified
+        baseline_memory = peak_memory()
+        sampler = ThreadSampler()
+        sampler.start()
+        for i in range(self.iterations):
+            if setup:
+                setup(i)
+            start = time.time()
+            function(i)
+            timings.append(time.time() - start)
+        peak_threads = sampler.stop()
+        memory = peak_memory()
+        memory_growth = None
+        if memory != None:
+            memory_growth = memory - baseline_memory
+        return {
+            'name': name,
+            'timings': timings,
+            'threads': peak_threads,
+            'requests': (self.server.requests - requests) /
+                float(self.iterations),
+            'not_modified': (self.server.not_modified - not_modified) /
+                float(self.iterations),
+            'memory': memory,
+            'memory_growth': memory_growth
+        }
+
+    def run(self, index):
+        manager = self.module.PackageManager()
+        installer = self.module.PackageInstaller()
+        name = self.operations[index]
+
+        if name == 'list_repositories (cold)':
+            return self.measure(name, lambda i: manager.list_repositories(),
+                lambda i: self.clear_caches())
+        if name == 'list_repositories (warm)':
+            manager.list_repositories()
+            return self.measure(name, lambda i: manager.list_repositories())
+        if name == 'list_repositories (revalidate)':
+            manager.list_repositories()
+            return self.measure(name,
+                lambda i: self.revalidate(manager.list_repositories),
+                lambda i: self.expire_caches())
+        if name == 'list_available_packages (cold)':
+            return self.measure(name,
+                lambda i: manager.list_available_packages(),
+                lambda i: self.clear_caches())
+        if name == 'list_available_packages (warm)':
+            manager.list_available_packages()
+            return self.measure(name,
+                lambda i: manager.list_available_packages())
+        if name == 'list_available_packages (revalidate)':
+            manager.list_available_packages()
+            return self.measure(name,
+                lambda i: self.revalidate(manager.list_available_packages),
+                lambda i: self.expire_caches())
+        if name == 'make_package_list (warm)':
+            installer.make_package_list()
+            return self.measure(name,
+                lambda i: installer.make_package_list())
+
+        packages = manager.list_available_packages()
+        names = sorted(packages.keys())
+        if name == 'install_package (new)':
+            return self.measure(name,
+                lambda i: manager.install_package(names[i % len(names)],
+                packages))
+        manager.install_package(names[0], packages)
+        return self.measure(name,
+            lambda i: manager.install_package(names[0], packages))
+
+    @classmethod
+    def report(cls, results):
+        print '%-38s %9s %9s %9s %9s %8s %8s %8s %10s %10s' % (
+            'operation', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'threads',
+            'requests', '304s', 'peak rss', 'rss growth')
+        for result in results:
+            timings = result['timings']
+            memory = 'n/a'
+            growth = 'n/a'
+            if result['memory'] != None:
+                memory = '%.1f MB' % (result['memory'] / 1024.0)
+                growth = '%.1f MB' % (result['memory_growth'] / 1024.0)
+            print '%-38s %9.2f %9.2f %9.2f %9.2f %8d %8.1f %8.1f %10s %10s' % (
+                result['name'], percentile(timings, 50) * 1000,
+                percentile(timings, 90) * 1000,
+                percentile(timings, 99) * 1000, max(timings) * 1000,
+                result['threads'], result['requests'],
+                result['not_modified'], memory, growth)
+
+
+def run_operation(options, index):
+    server = FakeServer(options.repositories, options.packages,
+        options.zip_size, options.zip_files, options.latency / 1000.0)
+    base_url = server.start()
+
+    settings = load_default_settings()
+    settings['repository_channels'] = [base_url + '/channel.json']
+    settings['repositories'] = []
+    settings['auto_upgrade'] = False
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        SublimeStub(data_dir, settings).install()
+        module = imp.load_source('Package Control', os.path.join(
+            package_control_dir, 'Package Control.py'))
+        result = Benchmark(module, server, options.iterations).run(index)
+        # Closing the keep-alive connections lets the server threads exit
+        # before the interpreter shuts down
+        module._connection_pool.close_all()
+    finally:
+        server.stop()
+        shutil.rmtree(data_dir, True)
+    return result
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--repositories', type='int', default=20,
+        help='number of repositories in the channel')
+    parser.add_option('--packages', type='int', default=50,
+        help='number of packages in each repository')
+    parser.add_option('--zip-size', type='int', default=65536,
+        help='uncompressed size of each package zip in bytes')
+    parser.add_option('--zip-files', type='int', default=20,
+        help='number of files in each package zip')
+    parser.add_option('--iterations', type='int', default=10,
+        help='number of times each operation is run')
+    parser.add_option('--latency', type='float', default=0,
+        help='milliseconds the server waits before each response')
+    parser.add_option('--operation', type='int', default=None,
+        help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.operation != None:
+        # The result goes back to the parent process on the last line
+        result = run_operation(options, options.operation)
+        print 'RESULT ' + json.dumps(result)
+        return
+
+    results = []
+    for index in range(len(Benchmark.operations)):
+        process = subprocess.Popen([sys.executable, os.path.abspath(
+            __file__)] + sys.argv[1:] + ['--operation', str(index)],
+            stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        lines = [line for line in output.splitlines() if
+            line.startswith('RESULT ')]
+        if process.returncode != 0 or not lines:
+            sys.stdout.write(output)
+            print 'Error: %s failed' % Benchmark.operations[index]
+            sys.exit(1)
+        results.append(json.loads(lines[-1][7:]))
+    Benchmark.report(results)
+
+
+if __name__ == '__main__':
+    main()